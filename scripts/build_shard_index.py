@@ -0,0 +1,22 @@
+import argparse
+import os
+import sys
+from glob import glob
+
+from tqdm import tqdm
+
+sys.path.append(".")
+from src.data.shard_index import write_shard_index
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data_root", type=str)
+    parser.add_argument("dataset_type", type=str, help="'individual' or 'group'")
+    args = parser.parse_args()
+    data_root = args.data_root
+    dataset_type = args.dataset_type
+
+    shard_pattern = os.path.join(data_root, "**", "shards", f"{dataset_type}-*.tar")
+    shard_paths = sorted(glob(shard_pattern, recursive=True))
+    for shard_path in tqdm(shard_paths, ncols=100):
+        write_shard_index(shard_path)
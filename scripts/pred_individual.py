@@ -1,15 +1,18 @@
 import argparse
 import os
-import pickle
 import sys
 from glob import glob
 
-import torch
 from tqdm import tqdm
 
 sys.path.append(".")
-from src.data import individual_pred_dataloader
-from src.model import SQVAE, VAE
+from src.data import (
+    PredictionWriter,
+    get_prediction_dir,
+    individual_pred_dataloader,
+    load_individual_model,
+    predict_parallel,
+)
 from src.utils import yaml_handler
 
 if __name__ == "__main__":
@@ -20,11 +23,47 @@ if __name__ == "__main__":
     )
     parser.add_argument("-v", "--version", type=int, default=0)
     parser.add_argument("-g", "--gpu_id", type=int, default=None)
+    parser.add_argument(
+        "-lo",
+        "--labels_only",
+        required=False,
+        action="store_true",
+        default=False,
+        help="predict only labels without reconstruction (sqvae only)",
+    )
+    parser.add_argument(
+        "-nf",
+        "--no_features",
+        required=False,
+        action="store_true",
+        default=False,
+        help="not to save ze, zq and attention weights",
+    )
+    parser.add_argument(
+        "-np",
+        "--n_processes",
+        type=int,
+        required=False,
+        default=None,
+        help="number of CPU workers for data parallel inference",
+    )
+    parser.add_argument(
+        "-nt",
+        "--n_threads",
+        type=int,
+        required=False,
+        default=None,
+        help="number of intra-op threads of each CPU worker",
+    )
     args = parser.parse_args()
+    if args.labels_only and args.model_type != "sqvae":
+        parser.error("--labels_only is supported only for sqvae")
     data_root = args.data_root
     model_type = args.model_type
     v = args.version
     gpu_id = args.gpu_id
+    labels_only = args.labels_only
+    skip_columns = ["ze", "zq", "attn_w"] if args.no_features else None
     device = f"cuda:{gpu_id}"
 
     data_dirs = sorted(glob(os.path.join(data_root, "*/")))
@@ -38,36 +77,37 @@ if __name__ == "__main__":
     seq_len = config.seq_len
     stride = config.stride
 
-    # load model
-    if model_type == "vae":
-        model = VAE(config)
-    elif model_type == "sqvae":
-        model = SQVAE(config)
+    data_dirs = [d[:-1] if d[-1] == "/" else d for d in data_dirs]
+    if args.n_processes is not None:
+        # data parallel inference on CPU
+        predict_parallel(
+            data_dirs,
+            model_type,
+            config,
+            checkpoint_path,
+            args.n_processes,
+            args.n_threads,
+            labels_only,
+            skip_columns,
+        )
     else:
-        raise ValueError
-    model.configure_model()
-    model = model.to(device)
-    checkpoint = torch.load(checkpoint_path, map_location=device)
-    model.load_state_dict(checkpoint["state_dict"])
+        # load model
+        model = load_individual_model(model_type, config, checkpoint_path, device)
 
-    for data_dir in tqdm(data_dirs, ncols=100):
-        if data_dir[-1] == "/":
-            data_dir = data_dir[:-1]
-
-        # load dataset
-        dataloader = individual_pred_dataloader(
-            data_dir, "individual", config, [gpu_id]
-        )
+        for data_dir in tqdm(data_dirs, ncols=100):
+            # load dataset
+            dataloader = individual_pred_dataloader(
+                data_dir, "individual", config, [gpu_id], is_mapped=False
+            )
 
-        # pred
-        save_dir = os.path.join(data_dir, f"pred_{model_type}")
-        os.makedirs(save_dir, exist_ok=True)
+            # pred
+            save_dir = get_prediction_dir(data_dir, model_type)
+            writer = PredictionWriter(save_dir, skip_columns)
 
-        model.eval()
-        for batch in tqdm(dataloader, desc=f"{data_dir[-2:]}", ncols=100):
-            results = model.predict_step(batch)
-            for result in results:
-                key = result["key"]
-                path = os.path.join(save_dir, f"{key}.pkl")
-                with open(path, "wb") as f:
-                    pickle.dump(result, f)
+            for batch in tqdm(dataloader, desc=f"{data_dir[-2:]}", ncols=100):
+                if labels_only:
+                    results = model.predict_labels(batch)
+                else:
+                    results = model.predict_step(batch)
+                writer.write(results)
+            writer.close()
@@ -29,12 +29,21 @@ if __name__ == "__main__":
         default=False,
     )
     parser.add_argument("-ckpt", "--checkpoint", required=False, type=str, default=None)
+    parser.add_argument(
+        "-tr",
+        "--use_tracks",
+        required=False,
+        action="store_true",
+        default=False,
+        help="slice windows from the tracks of each video instead of the shards",
+    )
     args = parser.parse_args()
     data_root = args.data_root
     model_type = args.model_type
     unsupervised_training = args.unsupervised_training
     gpu_ids = args.gpu_ids
     pre_checkpoint_path = args.checkpoint
+    use_tracks = args.use_tracks
 
     # load config
     config_path = f"configs/individual-{model_type}.yaml"
@@ -88,7 +97,8 @@ if __name__ == "__main__":
         "individual",
         config,
         gpu_ids,
-        is_mapped=False,
+        is_mapped=use_tracks,
+        use_tracks=use_tracks,
     )
 
     # create model
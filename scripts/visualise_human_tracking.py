@@ -8,6 +8,7 @@ from tqdm import tqdm
 
 sys.path.append(".")
 from src.data import load_dataset_mapped
+from src.data.transform import individual_collate_fn
 from src.utils import video, vis, yaml_handler
 
 
@@ -42,7 +43,9 @@ if __name__ == "__main__":
 
     # load dataset
     dataset = load_dataset_mapped(data_dirs, "individual", config, False)
-    dataloader = DataLoader(dataset, num_workers=1, pin_memory=True)
+    dataloader = DataLoader(
+        dataset, num_workers=1, pin_memory=True, collate_fn=individual_collate_fn
+    )
 
     # load video
     video_path = f"{data_dir}.mp4"
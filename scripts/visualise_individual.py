@@ -1,6 +1,5 @@
 import argparse
 import os
-import pickle
 import sys
 from glob import glob
 
@@ -9,6 +8,7 @@ import numpy as np
 from tqdm import tqdm
 
 sys.path.append(".")
+from src.data import PredictionReader, get_prediction_dir
 from src.utils import video, vis, yaml_handler
 
 if __name__ == "__main__":
@@ -40,11 +40,7 @@ if __name__ == "__main__":
             data_dir = data_dir[:-1]
 
         # load results
-        paths = glob(os.path.join(data_dir, f"pred_{model_type}", "*"))
-        results = []
-        for path in paths:
-            with open(path, "rb") as f:
-                results.append(pickle.load(f))
+        results = PredictionReader(get_prediction_dir(data_dir, model_type))
 
         # load video
         video_path = f"{data_dir}.mp4"
@@ -77,9 +73,7 @@ if __name__ == "__main__":
                 n_frame_result = seq_len + ((n_frame - seq_len) // stride + 1) * stride
                 idx_data = seq_len - (n_frame_result - n_frame)
 
-            result_tmp = [
-                r for r in results if int(r["key"].split("_")[1]) == n_frame_result
-            ]
+            result_tmp = results.get_by_n_frame(n_frame_result)
 
             # put frame number
             frame = cv2.putText(
@@ -6,7 +6,7 @@ from glob import glob
 sys.path.append(".")
 from tqdm import tqdm
 
-from src.data import write_shards
+from src.data import write_shards, write_shards_parallel
 from src.model import HumanTracking
 from src.utils import yaml_handler
 
@@ -27,7 +27,23 @@ if __name__ == "__main__":
         default="configs/human_tracking.yaml",
     )
     parser.add_argument("-np", "--n_processes", type=int, required=False, default=None)
-    parser.add_argument("-g", "--gpu", type=int, required=False, default=1)
+    parser.add_argument(
+        "-nv",
+        "--n_videos",
+        type=int,
+        required=False,
+        default=None,
+        help="number of videos processed concurrently by persistent workers",
+    )
+    parser.add_argument("-g", "--gpus", type=int, nargs="*", required=False, default=[1])
+    parser.add_argument(
+        "-to",
+        "--tracks_only",
+        required=False,
+        action="store_true",
+        default=False,
+        help="write only the tracks store for training with -tr/--use_tracks",
+    )
     args = parser.parse_args()
 
     video_paths = sorted(glob(os.path.join(args.data_root, "*.mp4")))
@@ -36,12 +52,33 @@ if __name__ == "__main__":
     cfg_path = os.path.join(args.config_dir, f"{dataset_type}-dataset.yaml")
     config = yaml_handler.load(cfg_path)
     config_ht = yaml_handler.load(args.config_human_tracking_path)
-    device = f"cuda:{args.gpu}"
+    devices = [f"cuda:{gpu}" for gpu in args.gpus]
     n_processes = args.n_processes
 
-    model_ht = HumanTracking(config_ht, device)
-    for video_path in tqdm(video_paths, ncols=100, position=0):
-        write_shards(video_path, dataset_type, config, model_ht, n_processes, skip_optical_flow=True)
-        # model_ht.reset_tracker()
+    if args.n_videos is not None:
+        write_shards_parallel(
+            video_paths,
+            dataset_type,
+            config,
+            config_ht,
+            devices,
+            args.n_videos,
+            skip_optical_flow=True,
+            tracks_only=args.tracks_only,
+        )
+    else:
+        model_ht = HumanTracking(config_ht, devices[0])
+        for video_path in tqdm(video_paths, ncols=100, position=0):
+            write_shards(
+                video_path,
+                dataset_type,
+                config,
+                model_ht,
+                n_processes,
+                skip_optical_flow=True,
+                config_ht=config_ht,
+                tracks_only=args.tracks_only,
+            )
+            # model_ht.reset_tracker()
 
-    del model_ht
+        del model_ht
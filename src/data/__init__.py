@@ -6,4 +6,11 @@ from .dataset import (
     load_dataset_mapped,
 )
 from .graph import DynamicSpatialTemporalGraph
-from .write_shards import write_shards
+from .prediction import (
+    PredictionReader,
+    PredictionWriter,
+    get_prediction_dir,
+    load_individual_model,
+    predict_parallel,
+)
+from .write_shards import write_shards, write_shards_parallel
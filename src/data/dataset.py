@@ -1,63 +1,158 @@
 import functools
 import itertools
+import mmap
 import os
-import tarfile
 from glob import glob
 from math import ceil
 from types import SimpleNamespace
 from typing import Tuple, Union
 
+import numpy as np
 import webdataset as wds
 from torch.utils.data import DataLoader, Dataset
-from tqdm import tqdm
 
+from src.utils.columnar import load_columns, load_length
+
+from .shard_index import MERGED_INDEX_DTYPE, load_merged_index, load_shard_index
+from .tensor_cache import get_cached_sample, iter_tensor_cache, load_tensor_cache
+from .tracks import Tracks, get_tracks_dir
 from .transform import (
     FlowToTensor,
     FrameToTensor,
     NormalizeBbox,
     NormalizeKeypoints,
     group_npz_to_tensor,
+    individual_collate_fn,
     individual_npz_to_tensor,
+    individual_to_tensor,
 )
 
 
 class IndividualDatasetMapped(Dataset):
     def __init__(self, shard_paths, func_to_tensor):
-        self.keys = []
-        self.ids = []
-        self.bboxs = []
-        self.kps = []
-        self.masks = []
-
-        for path in tqdm(shard_paths, ncols=100, desc="loading shards"):
-            with tarfile.open(path, "r") as tar:
-                for tarinfo in tar:
-                    name = tarinfo.name.split(".")[0]
-                    sample = tar.extractfile(tarinfo).read()
-                    sample = dict(__key__=name, npz=sample)
-                    key, _id, bbox, kps, mask = func_to_tensor(sample)
-                    self.keys.append(key)
-                    self.ids.append(_id)
-                    self.bboxs.append(bbox)
-                    self.kps.append(kps)
-                    self.masks.append(mask)
+        self.shard_paths = shard_paths
+        self.func_to_tensor = func_to_tensor
+
+        # offset table of all samples in order of (n_frame, id) of each video,
+        # sample bytes are read on demand
+        indices = [np.empty((0,), MERGED_INDEX_DTYPE)]
+        shard_idxs = [np.empty((0,), np.int32)]
+        n_shards = 0
+        for _, paths in itertools.groupby(shard_paths, key=os.path.dirname):
+            paths = list(paths)
+            index, shard_idxs_video = load_merged_index(paths)
+            indices.append(index)
+            shard_idxs.append((shard_idxs_video + n_shards).astype(np.int32))
+            n_shards += len(paths)
+        self.shard_idxs = np.concatenate(shard_idxs)
+        indices = np.concatenate(indices)
+        self.keys = indices["key"]
+        self.offsets = indices["offset"]
+        self.sizes = indices["size"]
+
+        self.mmaps = {}  # opened lazily in each process
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["mmaps"] = {}  # mmap objects cannot be sent to workers
+        return state
+
+    def _get_mmap(self, shard_idx):
+        if shard_idx not in self.mmaps:
+            with open(self.shard_paths[shard_idx], "rb") as f:
+                self.mmaps[shard_idx] = mmap.mmap(
+                    f.fileno(), 0, access=mmap.ACCESS_READ
+                )
+        return self.mmaps[shard_idx]
 
     def __len__(self):
         return len(self.keys)
 
     def __getitem__(self, index):
-        key = self.keys[index]
-        _id = self.ids[index]
-        bbox = self.bboxs[index]
-        kps = self.kps[index]
-        mask = self.masks[index]
+        buf = self._get_mmap(int(self.shard_idxs[index]))
+        offset = int(self.offsets[index])
+        sample = buf[offset : offset + int(self.sizes[index])]
+        sample = dict(__key__=str(self.keys[index]), npz=sample)
+        key, _id, bbox, kps, mask = self.func_to_tensor(sample)
         return key, _id, bbox, kps, mask
 
 
+class IndividualDatasetCached(Dataset):
+    def __init__(self, cache_dirs):
+        self.cache_dirs = cache_dirs
+        self.columns = None  # loaded lazily in each process
+        lengths = [load_length(cache_dir) for cache_dir in cache_dirs]
+        self.cum_lengths = np.cumsum([0] + lengths)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # memmaps are pickled with all of their data, reloaded in each process
+        state["columns"] = None
+        return state
+
+    def _get_columns(self, i):
+        if self.columns is None:
+            self.columns = [load_columns(cache_dir) for cache_dir in self.cache_dirs]
+        return self.columns[i]
+
+    def __len__(self):
+        return int(self.cum_lengths[-1])
+
+    def __getitem__(self, index):
+        i = np.searchsorted(self.cum_lengths, index, side="right") - 1
+        return get_cached_sample(self._get_columns(i), index - self.cum_lengths[i])
+
+
+class IndividualDatasetTracks(Dataset):
+    def __init__(self, tracks_dirs, seq_len, stride, func_to_tensor):
+        self.seq_len = seq_len
+        self.func_to_tensor = func_to_tensor
+
+        # windows are sliced from the time series of tracks on demand
+        self.tracks = [Tracks(tracks_dir) for tracks_dir in tracks_dirs]
+        windows = [tracks.get_windows(seq_len, stride) for tracks in self.tracks]
+        self.video_idxs = np.concatenate(
+            [np.full(len(w[0]), i, np.int32) for i, w in enumerate(windows)]
+        )
+        self.track_idxs = np.concatenate([w[0] for w in windows])
+        self.rows = np.concatenate([w[1] for w in windows])
+        self.n_frames = np.concatenate([w[2] for w in windows])
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        tracks = self.tracks[self.video_idxs[index]]
+        track_idx = self.track_idxs[index]
+        _id = tracks.track_ids[track_idx]
+        key = f"{tracks.video_name}_{self.n_frames[index]}_{_id}"
+        bboxs, kps = tracks.get_window(track_idx, self.rows[index], self.seq_len)
+        return self.func_to_tensor(key, np.array(_id), bboxs, kps, tracks.frame_size)
+
+
+class IndividualDatasetIterableCached(wds.DataPipeline, wds.FluidInterface):
+    def __init__(self, cache_dirs, shuffle):
+        super().__init__()
+        self.append(wds.SimpleShardList(cache_dirs))
+        self.append(_node_splitter)
+        self.append(wds.split_by_worker)
+        if shuffle:
+            self.append(wds.shuffle(100))
+        self.append(functools.partial(iter_tensor_cache, shuffle=shuffle))
+
+
 def load_dataset_mapped(
-    data_dirs: list, dataset_type: str, config: SimpleNamespace
+    data_dirs: list,
+    dataset_type: str,
+    config: SimpleNamespace,
+    use_cache=True,
+    use_tracks=False,
 ) -> Dataset:
+    if use_tracks:
+        return load_dataset_tracks(data_dirs, dataset_type, config)
+
     shard_paths = []
+    shard_paths_dirs = []
 
     seq_len = int(config.seq_len)
     stride = int(config.stride)
@@ -66,6 +161,7 @@ def load_dataset_mapped(
     for dir_path in data_dirs:
         shard_paths_tmp = sorted(glob(os.path.join(dir_path, "shards", shard_pattern)))
         shard_paths += shard_paths_tmp
+        shard_paths_dirs.append(shard_paths_tmp)
 
     if dataset_type == "individual":
         idv_npz_to_tensor = functools.partial(
@@ -78,8 +174,16 @@ def load_dataset_mapped(
             mask_leg=config.mask_leg,
             range_points=config.range_points,
             load_frame_flow=False,  # avoid memory overflow
+            interpolate=False,  # interpolated in batch by individual_collate_fn
         )
-        dataset = IndividualDatasetMapped(shard_paths, idv_npz_to_tensor)
+        if use_cache:
+            cache_dirs = [
+                load_tensor_cache(d, paths, dataset_type, config, idv_npz_to_tensor)
+                for d, paths in zip(data_dirs, shard_paths_dirs)
+            ]
+            dataset = IndividualDatasetCached(cache_dirs)
+        else:
+            dataset = IndividualDatasetMapped(shard_paths, idv_npz_to_tensor)
     elif dataset_type == "group":
         # grp_npz_to_tensor = functools.partial(
         #     group_npz_to_tensor,
@@ -94,10 +198,39 @@ def load_dataset_mapped(
     return dataset
 
 
+def load_dataset_tracks(
+    data_dirs: list, dataset_type: str, config: SimpleNamespace
+) -> Dataset:
+    # windows of any seq_len and stride without shards
+    seq_len = int(config.seq_len)
+    stride = int(config.stride)
+    if dataset_type == "individual":
+        idv_to_tensor = functools.partial(
+            individual_to_tensor,
+            seq_len=seq_len,
+            bbox_transform=NormalizeBbox(),
+            kps_transform=NormalizeKeypoints(),
+            mask_leg=config.mask_leg,
+            range_points=config.range_points,
+            interpolate=False,  # interpolated in batch by individual_collate_fn
+        )
+        tracks_dirs = [get_tracks_dir(d) for d in data_dirs]
+        dataset = IndividualDatasetTracks(tracks_dirs, seq_len, stride, idv_to_tensor)
+    else:
+        raise ValueError
+
+    return dataset
+
+
 def load_dataset_iterable(
-    data_dirs: list, dataset_type: str, config: SimpleNamespace, shuffle: bool
+    data_dirs: list,
+    dataset_type: str,
+    config: SimpleNamespace,
+    shuffle: bool,
+    use_cache=True,
 ) -> Tuple[wds.WebDataset, int]:
     shard_paths = []
+    shard_paths_dirs = []
 
     seq_len = int(config.seq_len)
     stride = int(config.stride)
@@ -107,15 +240,9 @@ def load_dataset_iterable(
     for dir_path in data_dirs:
         shard_paths_tmp = sorted(glob(os.path.join(dir_path, "shards", shard_pattern)))
         shard_paths += shard_paths_tmp
-        n_samples += (len(shard_paths_tmp) - 1) * config.max_shard_count
-        with tarfile.open(shard_paths_tmp[-1]) as tar:
-            n_samples += len(tar.getnames())
-
-    dataset = wds.WebDataset(
-        shard_paths, shardshuffle=shuffle, nodesplitter=_node_splitter
-    )
-    if shuffle:
-        dataset = dataset.shuffle(100)
+        shard_paths_dirs.append(shard_paths_tmp)
+        # count samples from sidecar indices without reading sample bytes
+        n_samples += sum([len(load_shard_index(path)) for path in shard_paths_tmp])
 
     if dataset_type == "individual":
         idv_npz_to_tensor = functools.partial(
@@ -128,8 +255,17 @@ def load_dataset_iterable(
             mask_leg=config.mask_leg,
             range_points=config.range_points,
             load_frame_flow=False,  # TODO: set True when use frame and flow
+            interpolate=False,  # interpolated in batch by individual_collate_fn
         )
-        dataset = dataset.map(idv_npz_to_tensor)
+        if use_cache:
+            cache_dirs = [
+                load_tensor_cache(d, paths, dataset_type, config, idv_npz_to_tensor)
+                for d, paths in zip(data_dirs, shard_paths_dirs)
+            ]
+            dataset = IndividualDatasetIterableCached(cache_dirs, shuffle)
+        else:
+            dataset = _create_webdataset(shard_paths, shuffle)
+            dataset = dataset.map(idv_npz_to_tensor)
     elif dataset_type == "group":
         grp_npz_to_tensor = functools.partial(
             group_npz_to_tensor,
@@ -137,6 +273,7 @@ def load_dataset_iterable(
             flow_transform=FlowToTensor(),
             point_transform=NormalizeBbox(),
         )
+        dataset = _create_webdataset(shard_paths, shuffle)
         dataset = dataset.map(grp_npz_to_tensor)
     else:
         raise ValueError
@@ -144,29 +281,44 @@ def load_dataset_iterable(
     return dataset, n_samples
 
 
+def _create_webdataset(shard_paths, shuffle):
+    dataset = wds.WebDataset(
+        shard_paths, shardshuffle=shuffle, nodesplitter=_node_splitter
+    )
+    if shuffle:
+        dataset = dataset.shuffle(100)
+    return dataset
+
+
 def individual_train_dataloader(
     data_root: str,
     dataset_type: str,
     config: SimpleNamespace,
     gpu_ids: list,
     is_mapped: bool,
+    use_tracks: bool = False,
 ) -> Union[DataLoader, wds.WebLoader]:
     data_dirs = sorted(glob(os.path.join(data_root, "*/")))
 
     if is_mapped:
-        dataset = load_dataset_mapped(data_dirs, dataset_type, config)
+        dataset = load_dataset_mapped(
+            data_dirs, dataset_type, config, use_tracks=use_tracks
+        )
         dataloader = DataLoader(
             dataset,
             config.batch_size,
             shuffle=True,
             num_workers=config.num_workers,
             pin_memory=True,
+            collate_fn=individual_collate_fn,
         )
     else:
         dataset, n_batches = load_dataset_iterable(
             data_dirs, dataset_type, config, True
         )
-        dataset = dataset.batched(config.batch_size, partial=False)
+        dataset = dataset.batched(
+            config.batch_size, partial=False, collation_fn=individual_collate_fn
+        )
 
         # create dataloader
         dataloader = wds.WebLoader(
@@ -189,21 +341,27 @@ def individual_pred_dataloader(
     config: SimpleNamespace,
     gpu_ids: list,
     is_mapped: bool,
+    use_tracks: bool = False,
 ) -> Union[DataLoader, wds.WebLoader]:
     if is_mapped:
-        dataset = load_dataset_mapped([data_dir], dataset_type, config)
+        dataset = load_dataset_mapped(
+            [data_dir], dataset_type, config, use_tracks=use_tracks
+        )
         dataloader = DataLoader(
             dataset,
             config.batch_size,
             shuffle=False,
             num_workers=config.num_workers,
             pin_memory=True,
+            collate_fn=individual_collate_fn,
         )
     else:
         dataset, n_batches = load_dataset_iterable(
             [data_dir], dataset_type, config, False
         )
-        dataset = dataset.batched(config.batch_size, partial=True)
+        dataset = dataset.batched(
+            config.batch_size, partial=True, collation_fn=individual_collate_fn
+        )
 
         # create dataloader
         dataloader = wds.WebLoader(
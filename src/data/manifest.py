@@ -0,0 +1,142 @@
+import hashlib
+import json
+import os
+from glob import glob
+from types import SimpleNamespace
+
+from .shard_index import (
+    get_index_path,
+    get_merged_index_path,
+    get_shard_number,
+    write_merged_index,
+)
+
+
+def calc_fingerprint(video_path: str, config: SimpleNamespace, **kwargs) -> str:
+    # hash head and tail of the video instead of the whole file for speed
+    chunk_size = 2**20
+    file_size = os.path.getsize(video_path)
+    video_hash = hashlib.sha1()
+    with open(video_path, "rb") as f:
+        video_hash.update(f.read(chunk_size))
+        f.seek(max(file_size - chunk_size, 0))
+        video_hash.update(f.read(chunk_size))
+
+    items = {
+        "video": [os.path.basename(video_path), file_size, video_hash.hexdigest()],
+        "config": vars(config),
+        **kwargs,
+    }
+    items = json.dumps(items, sort_keys=True, default=str)
+    return hashlib.sha1(items.encode()).hexdigest()
+
+
+class ShardManifest:
+    def __init__(self, shard_pattern: str, fingerprint: str, stride: int):
+        self.shard_pattern = shard_pattern
+        self.fingerprint = fingerprint
+        self.stride = stride
+        self.path = shard_pattern.replace("-%06d.tar", "-manifest.json")
+
+        data = self._load()
+        if data is None or data["fingerprint"] != fingerprint:
+            # config or source video has been changed, all shards are regenerated
+            data = {
+                "fingerprint": fingerprint,
+                "completed": False,
+                "shards": [],
+            }
+            self._save(data)
+        self._remove_unregistered_shards(data)
+
+    @property
+    def is_completed(self) -> bool:
+        return self._load()["completed"]
+
+    @property
+    def completed_windows(self) -> set:
+        n_frames = set()
+        for shard in self._load()["shards"]:
+            for start, stop in shard["windows"]:
+                n_frames.update(range(start, stop + 1, self.stride))
+        return n_frames
+
+    @property
+    def next_shard(self) -> int:
+        shard_idxs = [shard["shard"] for shard in self._load()["shards"]]
+        shard_idxs = [idx for idx in shard_idxs if idx is not None]
+        return max(shard_idxs) + 1 if len(shard_idxs) > 0 else 0
+
+    @property
+    def shard_paths(self) -> list:
+        shards = self._load()["shards"]
+        return [
+            self.shard_pattern % s["shard"] for s in shards if s["shard"] is not None
+        ]
+
+    @property
+    def n_samples(self) -> int:
+        return sum([shard["n_samples"] for shard in self._load()["shards"]])
+
+    def add_shard(self, shard_path: str, n_samples: int, windows: list):
+        # shard_path is None when all windows of the shard have no samples
+        if shard_path is not None:
+            shard_idx = get_shard_number(shard_path)
+        else:
+            shard_idx = None
+
+        data = self._load()
+        data["shards"].append(
+            {
+                "shard": shard_idx,
+                "n_samples": int(n_samples),
+                "windows": self._to_ranges(windows),
+            }
+        )
+        self._save(data)
+
+    def set_completed(self):
+        # samples of all shards in order of (n_frame, id)
+        index_path = get_merged_index_path(self.shard_pattern)
+        write_merged_index(index_path, self.shard_paths)
+
+        data = self._load()
+        data["completed"] = True
+        self._save(data)
+
+    def _to_ranges(self, n_frames):
+        ranges = []
+        for n_frame in sorted(set(n_frames)):
+            if len(ranges) > 0 and ranges[-1][1] + self.stride == n_frame:
+                ranges[-1][1] = n_frame
+            else:
+                ranges.append([n_frame, n_frame])
+        return ranges
+
+    def _remove_unregistered_shards(self, data):
+        # remove shards which were interrupted while writing
+        registered = [
+            self.shard_pattern % s["shard"]
+            for s in data["shards"]
+            if s["shard"] is not None
+        ]
+        for path in glob(self.shard_pattern.replace("%06d", "*")):
+            if path not in registered:
+                os.remove(path)
+                if os.path.exists(get_index_path(path)):
+                    os.remove(get_index_path(path))
+        for path in glob(self.shard_pattern.replace("%06d", "*") + ".tmp"):
+            os.remove(path)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, "r") as f:
+            return json.load(f)
+
+    def _save(self, data):
+        # write atomically not to break the manifest by interruption
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
@@ -1,5 +1,4 @@
-import time
-from collections import deque
+import os
 from multiprocessing import shared_memory
 from multiprocessing.managers import SyncManager
 from threading import Lock
@@ -7,6 +6,8 @@ from threading import Lock
 import numpy as np
 import webdataset as wds
 
+from .shard_index import write_shard_index
+
 
 class ShardWritingManager(SyncManager):
     pass
@@ -39,52 +40,80 @@ class SharedNDArray:
         self.shm.unlink()
 
 
-class SharedShardWriter(wds.ShardWriter):
-    def __init__(self, shard_pattern, maxcount, verbose=0):
-        super().__init__(shard_pattern, maxcount, verbose=verbose)
-        self.write_que = deque()
+class WindowShardWriter(wds.ShardWriter):
+    def __init__(self, shard_pattern, maxcount, manifest=None, verbose=0):
+        self.manifest = manifest
+        self.windows = []
+        start_shard = manifest.next_shard if manifest is not None else 0
+        super().__init__(
+            shard_pattern,
+            maxcount,
+            post=self._post_shard,
+            start_shard=start_shard,
+            verbose=verbose,
+        )
+
+    def write_window(self, n_frame, samples):
+        # samples of a window are never split into two shards,
+        # so that a window is completed when its shard has been closed
+        if self.count > 0 and (
+            self.count + len(samples) > self.maxcount or self.size >= self.maxsize
+        ):
+            self.next_stream()
+        for data in samples:
+            size = self.tarstream.write(data)
+            self.count += 1
+            self.total += 1
+            self.size += size
+        if n_frame is not None:
+            self.windows.append(n_frame)
+
+    def _post_shard(self, fname):
+        if self.count == 0:
+            os.remove(fname)  # remove empty shard
+            fname = None
+        else:
+            write_shard_index(fname)
+        if self.manifest is not None and (fname is not None or len(self.windows) > 0):
+            self.manifest.add_shard(fname, self.count, self.windows)
+        self.windows = []
+
+
+class SharedShardRegistry:
+    # shard numbers and the manifest shared by the shard writers of all workers
+    def __init__(self, manifest):
+        self.manifest = manifest
+        self.next_shard = manifest.next_shard
         self.lock = Lock()
-        self.finished = False
-        self.watch_dog_count = 0
-        self.verbose = bool(verbose)
 
-    def add_write_que(self, data):
+    def allocate_shard(self):
+        with self.lock:
+            shard = self.next_shard
+            self.next_shard += 1
+        return shard
+
+    def add_shard(self, shard_path, n_samples, windows):
         with self.lock:
-            self.write_que.append(data)
-        if self.verbose:
-            print(f"Put, qsize:{self.write_que_size()}")
-
-    def set_finish_writing(self):
-        self.write_que.append(None)
-        self.finished = True
-
-    def write_que_size(self):
-        return len(self.write_que)
-
-    def is_write_que_empty(self):
-        return len(self.write_que) == 0
-
-    def write_async(self):
-        while True:
-            while self.is_write_que_empty():
-                time.sleep(0.001)
-
-                self.watch_dog_count += 1
-                if self.watch_dog_count > 60 * 10 / 0.001:  # wait for 10 min
-                    raise RuntimeError(
-                        "The dog barked in SharedShardWriter.write_async process!"
-                    )
-            self.watch_dog_count = 0
-
-            with self.lock:
-                data = self.write_que.popleft()
-            if data is None:
-                return  # complete writing all data
-            self.write(data)
-            del data
-
-            if self.finished:
-                print("Remaining write queue size:", self.write_que_size() - 1)
-            else:
-                if self.verbose:
-                    print(f"Pop and written, qsize:{self.write_que_size()}")
+            self.manifest.add_shard(shard_path, n_samples, windows)
+
+
+class DirectShardWriter(WindowShardWriter):
+    # shard writer of each worker, which writes samples into its own shards
+    # without sending them to another process
+    def __init__(self, shard_pattern, maxcount, registry, verbose=0):
+        self.registry = registry
+        super().__init__(shard_pattern, maxcount, verbose=verbose)
+        self.manifest = registry  # shards are registered through the registry
+
+    def next_stream(self):
+        self.finish()
+        self.shard = self.registry.allocate_shard()
+        self.fname = self.pattern % self.shard
+        # written in a temporary file not to leave a broken shard
+        self.tarstream = wds.TarWriter(self.fname + ".tmp", **self.kw)
+        self.count = 0
+        self.size = 0
+
+    def _post_shard(self, fname):
+        os.replace(fname + ".tmp", fname)
+        super()._post_shard(fname)
@@ -0,0 +1,220 @@
+import functools
+import os
+import shutil
+from glob import glob
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+from torch.multiprocessing import Pool, set_start_method
+from torch.utils.data import DataLoader, Subset
+from tqdm import tqdm
+
+from src.model import SQVAE, VAE
+from src.utils.columnar import ColumnarWriter, load_columns
+
+from .dataset import load_dataset_mapped
+from .shard_index import INDEX_DTYPE
+from .transform import individual_collate_fn
+
+
+def get_prediction_dir(data_dir: str, model_type: str) -> str:
+    return os.path.join(data_dir, f"pred_{model_type}")
+
+
+class PredictionWriter:
+    def __init__(self, dir_path: str, skip_columns: list = None):
+        if os.path.exists(dir_path):
+            # overwrite the predictions of the previous run
+            shutil.rmtree(dir_path)
+        self.writer = ColumnarWriter(dir_path)
+        self.skip_columns = skip_columns if skip_columns is not None else []
+
+    def write(self, results: dict):
+        # results: arrays of a batch, the first axis of each array is sample
+        keys = np.asarray(results["key"], INDEX_DTYPE["key"])
+        columns = {
+            name: np.asarray(vals)
+            for name, vals in results.items()
+            if name not in self.skip_columns
+        }
+        columns["key"] = keys
+        # key is {video_name}_{n_frame}_{id} and video_name may contain "_"
+        columns["n_frame"] = np.array(
+            [int(key.rsplit("_", 2)[1]) for key in keys], np.int64
+        )
+        self.writer.append(**columns)
+
+    def close(self):
+        if len(self.writer.columns) == 0:
+            # no samples, columns to search samples are kept for PredictionReader
+            self.write({"key": [], "id": np.empty((0,), np.int64)})
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class PredictionReader:
+    def __init__(self, dir_path: str, names: list = None):
+        if names is not None:
+            names = list(set(names) | {"key", "id", "n_frame"})
+        self.columns = load_columns(dir_path, names)
+
+        # indices sorted by n_frame and id to search samples
+        self._idxs_n_frame, self._sorted_n_frame = self._sort(self.columns["n_frame"])
+        self._idxs_id, self._sorted_id = self._sort(self.columns["id"])
+
+    @staticmethod
+    def _sort(vals):
+        idxs = np.argsort(vals, kind="stable")
+        return idxs, np.asarray(vals)[idxs]
+
+    def __len__(self):
+        return len(self.columns["key"])
+
+    def __getitem__(self, idx) -> dict:
+        # lightweight view of a sample
+        return {name: col[idx] for name, col in self.columns.items()}
+
+    @property
+    def n_frames(self) -> np.ndarray:
+        return np.unique(self._sorted_n_frame)
+
+    @property
+    def ids(self) -> np.ndarray:
+        return np.unique(self._sorted_id)
+
+    def get_idxs_by_n_frame(self, n_frame: int) -> np.ndarray:
+        lo, hi = np.searchsorted(self._sorted_n_frame, [n_frame, n_frame + 1])
+        return self._idxs_n_frame[lo:hi]
+
+    def get_idxs_by_id(self, _id: int) -> np.ndarray:
+        lo, hi = np.searchsorted(self._sorted_id, [_id, _id + 1])
+        return self._idxs_id[lo:hi]
+
+    def get_by_n_frame(self, n_frame: int) -> list:
+        return [self[idx] for idx in self.get_idxs_by_n_frame(n_frame)]
+
+    def get_by_id(self, _id: int) -> list:
+        return [self[idx] for idx in self.get_idxs_by_id(_id)]
+
+
+def load_individual_model(
+    model_type: str, config: SimpleNamespace, checkpoint_path: str, device: str
+):
+    if model_type == "vae":
+        model = VAE(config)
+    elif model_type == "sqvae":
+        model = SQVAE(config)
+    else:
+        raise ValueError
+    model.configure_model()
+    model = model.to(device)
+    checkpoint = torch.load(checkpoint_path, map_location=device)
+    model.load_state_dict(checkpoint["state_dict"])
+    model.eval()
+    return model
+
+
+def predict_parallel(
+    data_dirs: list,
+    model_type: str,
+    config: SimpleNamespace,
+    checkpoint_path: str,
+    n_workers: int,
+    n_threads: int = None,
+    labels_only: bool = False,
+    skip_columns: list = None,
+    chunk_size: int = None,
+):
+    # data parallel inference on CPU, each worker holds its own model
+    if n_threads is None:
+        n_threads = max(os.cpu_count() // n_workers, 1)
+    if chunk_size is None:
+        chunk_size = config.batch_size * 16
+
+    # build tensor caches in advance and split samples of each video into chunks
+    tasks = []
+    n_chunks = {}
+    for data_dir in data_dirs:
+        dataset = load_dataset_mapped([data_dir], "individual", config)
+        chunks = [
+            (data_dir, start, min(start + chunk_size, len(dataset)))
+            for start in range(0, len(dataset), chunk_size)
+        ]
+        tasks += chunks
+        n_chunks[data_dir] = len(chunks)
+        shutil.rmtree(_get_parts_dir(data_dir, model_type), ignore_errors=True)
+        if len(chunks) == 0:
+            # no samples in the video, an empty store is written
+            PredictionWriter(get_prediction_dir(data_dir, model_type)).close()
+
+    set_start_method("spawn", force=True)
+    init_args = (model_type, config, checkpoint_path, n_threads)
+    with Pool(n_workers, initializer=_init_worker, initargs=init_args) as pool:
+        predict_func = functools.partial(
+            _predict_worker,
+            model_type=model_type,
+            config=config,
+            labels_only=labels_only,
+            skip_columns=skip_columns,
+        )
+        n_finished = {data_dir: 0 for data_dir in data_dirs}
+        for data_dir in tqdm(
+            pool.imap_unordered(predict_func, tasks, chunksize=1),
+            total=len(tasks),
+            ncols=100,
+        ):
+            n_finished[data_dir] += 1
+            if n_finished[data_dir] == n_chunks[data_dir]:
+                _merge_parts(data_dir, model_type)
+
+
+def _get_parts_dir(data_dir: str, model_type: str) -> str:
+    return get_prediction_dir(data_dir, model_type) + ".parts"
+
+
+_worker_model = None
+
+
+def _init_worker(model_type, config, checkpoint_path, n_threads):
+    global _worker_model
+    torch.set_num_threads(n_threads)
+    torch.set_num_interop_threads(1)
+    _worker_model = load_individual_model(model_type, config, checkpoint_path, "cpu")
+
+
+@torch.no_grad()
+def _predict_worker(task, model_type, config, labels_only, skip_columns):
+    data_dir, start, stop = task
+
+    # the tensor cache has been built by the main process
+    dataset = load_dataset_mapped([data_dir], "individual", config)
+    dataset = Subset(dataset, range(start, stop))
+    dataloader = DataLoader(
+        dataset, config.batch_size, shuffle=False, collate_fn=individual_collate_fn
+    )
+
+    part_dir = os.path.join(_get_parts_dir(data_dir, model_type), f"{start:010d}")
+    with PredictionWriter(part_dir, skip_columns) as writer:
+        for batch in dataloader:
+            if labels_only:
+                results = _worker_model.predict_labels(batch)
+            else:
+                results = _worker_model.predict_step(batch)
+            writer.write(results)
+
+    return data_dir
+
+
+def _merge_parts(data_dir: str, model_type: str):
+    # concatenate results of chunks in order of samples
+    parts_dir = _get_parts_dir(data_dir, model_type)
+    with PredictionWriter(get_prediction_dir(data_dir, model_type)) as writer:
+        for part_dir in sorted(glob(os.path.join(parts_dir, "*"))):
+            writer.write(load_columns(part_dir))
+    shutil.rmtree(parts_dir)
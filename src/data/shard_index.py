@@ -0,0 +1,120 @@
+import os
+import tarfile
+
+import numpy as np
+
+INDEX_DTYPE = np.dtype(
+    [
+        ("key", "U128"),
+        ("offset", np.int64),  # byte offset of the sample data in the tar
+        ("size", np.int64),
+        ("id", np.int64),  # -1 for group samples
+        ("n_frame", np.int64),
+    ]
+)
+# index of all shards of a video
+MERGED_INDEX_DTYPE = np.dtype(INDEX_DTYPE.descr + [("shard", np.int64)])
+
+
+def get_index_path(shard_path: str) -> str:
+    return shard_path[: -len(".tar")] + ".idx.npy"
+
+
+def get_merged_index_path(shard_path: str) -> str:
+    # shard_path can be also the pattern of the shards
+    return shard_path.rsplit("-", 1)[0] + "-index.npy"
+
+
+def get_shard_number(shard_path: str) -> int:
+    return int(shard_path.split("-")[-1].split(".")[0])
+
+
+def build_shard_index(shard_path: str) -> np.ndarray:
+    dataset_type = os.path.basename(shard_path).split("-")[0]
+
+    index = []
+    with tarfile.open(shard_path, "r") as tar:
+        for tarinfo in tar:
+            if not tarinfo.isfile():
+                continue
+            key = tarinfo.name.split(".")[0]
+            if dataset_type == "individual":
+                _, n_frame, _id = key.rsplit("_", 2)
+            else:
+                _, n_frame = key.rsplit("_", 1)
+                _id = -1
+            index.append((key, tarinfo.offset_data, tarinfo.size, _id, n_frame))
+
+    return np.array(index, dtype=INDEX_DTYPE)
+
+
+def write_shard_index(shard_path: str) -> np.ndarray:
+    index = build_shard_index(shard_path)
+
+    # write atomically not to leave a broken index
+    index_path = get_index_path(shard_path)
+    tmp_path = index_path[: -len(".npy")] + f".tmp{os.getpid()}.npy"
+    np.save(tmp_path, index)
+    os.replace(tmp_path, index_path)
+
+    return index
+
+
+def load_shard_index(shard_path: str) -> np.ndarray:
+    index_path = get_index_path(shard_path)
+    if os.path.exists(index_path) and os.path.getmtime(
+        index_path
+    ) >= os.path.getmtime(shard_path):
+        return np.load(index_path)
+    else:
+        return write_shard_index(shard_path)
+
+
+def merge_shard_indices(shard_paths: list) -> np.ndarray:
+    # samples of a video in order of (n_frame, id), because the windows are
+    # scattered over the shards written by the workers in parallel
+    indices = [np.empty((0,), MERGED_INDEX_DTYPE)]
+    for shard_path in shard_paths:
+        index = load_shard_index(shard_path)
+        merged_index = np.empty(len(index), MERGED_INDEX_DTYPE)
+        for name in INDEX_DTYPE.names:
+            merged_index[name] = index[name]
+        merged_index["shard"] = get_shard_number(shard_path)
+        indices.append(merged_index)
+
+    index = np.concatenate(indices)
+    return index[np.lexsort((index["id"], index["n_frame"]))]
+
+
+def write_merged_index(index_path: str, shard_paths: list) -> np.ndarray:
+    index = merge_shard_indices(shard_paths)
+
+    # write atomically not to leave a broken index
+    tmp_path = index_path[: -len(".npy")] + f".tmp{os.getpid()}.npy"
+    np.save(tmp_path, index)
+    os.replace(tmp_path, index_path)
+
+    return index
+
+
+def load_merged_index(shard_paths: list):
+    # shard_paths: all shards of a video
+    # returns the merged index and the position in shard_paths of each sample
+    if len(shard_paths) == 0:
+        return np.empty((0,), MERGED_INDEX_DTYPE), np.empty((0,), np.int64)
+
+    shard_numbers = np.array([get_shard_number(path) for path in shard_paths])
+    index_path = get_merged_index_path(shard_paths[0])
+    index = None
+    if os.path.exists(index_path) and os.path.getmtime(index_path) >= max(
+        os.path.getmtime(path) for path in shard_paths
+    ):
+        index = np.load(index_path)
+        if not np.array_equal(np.unique(index["shard"]), np.unique(shard_numbers)):
+            index = None  # shards have been added or removed
+    if index is None:
+        index = write_merged_index(index_path, shard_paths)
+
+    order = np.argsort(shard_numbers)
+    shard_idxs = order[np.searchsorted(shard_numbers[order], index["shard"])]
+    return index, shard_idxs
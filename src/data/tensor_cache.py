@@ -0,0 +1,126 @@
+import hashlib
+import json
+import os
+import shutil
+from glob import glob
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from src.utils.columnar import ColumnarWriter, is_columnar, load_columns, load_length
+
+from .shard_index import INDEX_DTYPE, load_merged_index
+
+# config items which change the output of individual_npz_to_tensor
+CACHE_CONFIG_KEYS = ["seq_len", "stride", "mask_leg", "range_points"]
+# bump when the format of cached samples is changed
+# 2: samples are cached before interpolation, 3: in order of (n_frame, id)
+CACHE_VERSION = 3
+
+
+def calc_cache_fingerprint(shard_paths: list, config: SimpleNamespace) -> str:
+    # hashes of the config and of the shards, so that a cache can be replaced
+    # by the one of the same config when the shards have been updated
+    config_items = {
+        "version": CACHE_VERSION,
+        "config": {key: getattr(config, key) for key in CACHE_CONFIG_KEYS},
+    }
+    shard_items = [
+        [os.path.basename(p), os.path.getsize(p), os.path.getmtime(p)]
+        for p in shard_paths
+    ]
+    return f"{_calc_hash(config_items)[:16]}-{_calc_hash(shard_items)}"
+
+
+def _calc_hash(items) -> str:
+    items = json.dumps(items, sort_keys=True, default=str)
+    return hashlib.sha1(items.encode()).hexdigest()
+
+
+def get_cache_dir(
+    data_dir: str, dataset_type: str, config: SimpleNamespace, fingerprint: str
+) -> str:
+    seq_len = int(config.seq_len)
+    stride = int(config.stride)
+    cache_name = f"{dataset_type}-seq_len{seq_len}-stride{stride}-{fingerprint}"
+    return os.path.join(data_dir, "cache", cache_name)
+
+
+def load_tensor_cache(
+    data_dir: str,
+    shard_paths: list,
+    dataset_type: str,
+    config: SimpleNamespace,
+    func_to_tensor,
+) -> str:
+    fingerprint = calc_cache_fingerprint(shard_paths, config)
+    cache_dir = get_cache_dir(data_dir, dataset_type, config, fingerprint)
+    if not is_columnar(cache_dir):
+        build_tensor_cache(cache_dir, shard_paths, func_to_tensor)
+
+        # remove stale caches of the same config created from old shards,
+        # caches which are being built by other processes are kept
+        config_fingerprint = fingerprint.split("-")[0]
+        for path in glob(cache_dir.replace(fingerprint, f"{config_fingerprint}-*")):
+            if path != cache_dir and ".tmp" not in os.path.basename(path):
+                shutil.rmtree(path, ignore_errors=True)
+
+    return cache_dir
+
+
+def build_tensor_cache(cache_dir: str, shard_paths: list, func_to_tensor):
+    # build in a temporary directory not to leave a broken cache
+    tmp_dir = f"{cache_dir}.tmp{os.getpid()}"
+    index, shard_idxs = load_merged_index(shard_paths)
+    files = [open(shard_path, "rb") for shard_path in shard_paths]
+    with ColumnarWriter(tmp_dir) as writer:
+        desc = os.path.basename(os.path.dirname(os.path.dirname(cache_dir)))
+        for key, offset, size, shard_idx in tqdm(
+            zip(index["key"], index["offset"], index["size"], shard_idxs),
+            total=len(index),
+            ncols=100,
+            desc=f"cache {desc}",
+        ):
+            f = files[shard_idx]
+            f.seek(offset)
+            sample = dict(__key__=str(key), npz=f.read(size))
+            key, _id, kps, bbox, mask = func_to_tensor(sample)
+            writer.append(
+                key=np.array([key], INDEX_DTYPE["key"]),
+                id=[_id],
+                kps=kps.numpy()[np.newaxis],
+                bbox=bbox.numpy()[np.newaxis],
+                mask=mask.numpy()[np.newaxis],
+            )
+    for f in files:
+        f.close()
+
+    try:
+        os.replace(tmp_dir, cache_dir)
+    except OSError:
+        # another process has already built the same cache
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def iter_tensor_cache(cache_dirs, shuffle: bool = False):
+    for cache_dir in cache_dirs:
+        if isinstance(cache_dir, dict):
+            cache_dir = cache_dir["url"]  # from wds.SimpleShardList
+        columns = load_columns(cache_dir)
+        idxs = np.arange(load_length(cache_dir))
+        if shuffle:
+            np.random.shuffle(idxs)
+        for i in idxs:
+            yield get_cached_sample(columns, i)
+
+
+def get_cached_sample(columns: dict, i: int):
+    return (
+        str(columns["key"][i]),
+        np.array(columns["id"][i]),
+        torch.from_numpy(np.array(columns["kps"][i])),
+        torch.from_numpy(np.array(columns["bbox"][i])),
+        torch.from_numpy(np.array(columns["mask"][i])),
+    )
@@ -0,0 +1,126 @@
+import os
+import shutil
+from types import SimpleNamespace
+
+import numpy as np
+
+from src.utils.columnar import ColumnarWriter, is_columnar, load_columns
+
+from .manifest import calc_fingerprint
+
+# items of human_tracking.yaml which change only the throughput
+THROUGHPUT_KEYS = [("batch_size",), ("pose", "batch_size")]
+
+TRACKING_DTYPES = {
+    "n_frame": np.int32,
+    "id": np.int32,
+    "bbox": np.float32,
+    "keypoints": np.float32,
+}
+
+
+def get_tracking_dir(video_path: str, config_ht: SimpleNamespace) -> str:
+    # results of human tracking depend only on the video and human_tracking.yaml
+    data_root = os.path.dirname(video_path)
+    video_name = os.path.basename(video_path).split(".")[0]
+    fingerprint = calc_fingerprint(video_path, _remove_throughput_keys(config_ht))
+    return os.path.join(data_root, video_name, "tracking", fingerprint)
+
+
+def _remove_throughput_keys(config_ht: SimpleNamespace) -> SimpleNamespace:
+    def to_dict(config):
+        if isinstance(config, SimpleNamespace):
+            return {key: to_dict(val) for key, val in vars(config).items()}
+        return config
+
+    items = to_dict(config_ht)
+    for keys in THROUGHPUT_KEYS:
+        parent = items
+        for key in keys[:-1]:
+            parent = parent.get(key, {})
+        parent.pop(keys[-1], None)
+    return SimpleNamespace(**items)
+
+
+def has_tracking(tracking_dir: str) -> bool:
+    return tracking_dir is not None and is_columnar(tracking_dir)
+
+
+class TrackingWriter:
+    def __init__(self, dir_path: str, buffer_size: int = 1000):
+        self.dir_path = dir_path
+        # written in a temporary directory not to leave a broken store
+        self.tmp_dir = f"{dir_path}.tmp"
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        self.writer = ColumnarWriter(self.tmp_dir)
+        self.buffer_size = buffer_size
+        self.buffer = []
+
+    def write(self, idvs: list):
+        # idvs: results of HumanTracking.predict for a frame
+        self.buffer += idvs
+        if len(self.buffer) >= self.buffer_size:
+            self._flush()
+
+    def _flush(self):
+        if len(self.buffer) == 0:
+            return
+        columns = {
+            name: np.array([idv[name] for idv in self.buffer], dtype)
+            for name, dtype in TRACKING_DTYPES.items()
+        }
+        self.writer.append(**columns)
+        self.buffer = []
+
+    def close(self):
+        self._flush()
+        self.writer.close()
+        shutil.rmtree(self.dir_path, ignore_errors=True)
+        os.replace(self.tmp_dir, self.dir_path)
+
+    def abort(self):
+        self.writer.close()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class TrackingReader:
+    def __init__(self, dir_path: str):
+        self.columns = load_columns(dir_path)
+        if len(self.columns) == 0:
+            # nobody has been detected in the video
+            self.columns = {
+                name: np.empty((0,), dtype) for name, dtype in TRACKING_DTYPES.items()
+            }
+
+        # individuals are stored in order of frames
+        self.n_frames = np.asarray(self.columns["n_frame"])
+
+    def __len__(self):
+        return len(self.n_frames)
+
+    def get_idxs_by_n_frame(self, n_frame: int) -> slice:
+        lo, hi = np.searchsorted(self.n_frames, [n_frame, n_frame + 1])
+        return slice(lo, hi)
+
+    def get_by_n_frame(self, n_frame: int) -> list:
+        idxs = self.get_idxs_by_n_frame(n_frame)
+        ids = self.columns["id"][idxs]
+        bboxs = np.asarray(self.columns["bbox"][idxs])
+        kps = np.asarray(self.columns["keypoints"][idxs])
+        return [
+            {"n_frame": n_frame, "id": int(_id), "bbox": bbox, "keypoints": kp}
+            for _id, bbox, kp in zip(ids, bboxs, kps)
+        ]
+
+    def iter_frames(self, frame_count: int):
+        for n_frame in range(frame_count):
+            yield self.get_by_n_frame(n_frame)
@@ -0,0 +1,217 @@
+import os
+import shutil
+
+import numpy as np
+
+from src.utils.columnar import ColumnarWriter, is_columnar, load_attrs, load_columns
+
+# value of the frames where the individual is not detected, same as the shards
+NAN_VALUE = -1e10
+
+
+def get_tracks_dir(data_dir: str) -> str:
+    return os.path.join(data_dir, "tracks")
+
+
+def is_tracks_updated(tracks_dir: str, source: str) -> bool:
+    return is_columnar(tracks_dir) and load_attrs(tracks_dir).get("source") == source
+
+
+def write_tracks(
+    tracks_dir: str,
+    idvs_iter,
+    video_name: str,
+    frame_count: int,
+    frame_size: tuple,
+    source: str,
+    chunk_size: int = 2**20,
+):
+    # individuals of each frame are collected in order of frames at first,
+    # and then they are rearranged into a continuous time series of each track
+    dets_dir = f"{tracks_dir}.dets.tmp"
+    shutil.rmtree(dets_dir, ignore_errors=True)
+    with ColumnarWriter(dets_dir) as writer:
+        buf = []
+        for idvs in idvs_iter:
+            buf += idvs
+            if len(buf) >= chunk_size // 64:
+                _append_dets(writer, buf)
+                buf = []
+        _append_dets(writer, buf)
+    dets = load_columns(dets_dir)
+
+    # frame_size: (h, w)
+    attrs = dict(
+        video_name=video_name,
+        frame_count=int(frame_count),
+        frame_size=[int(frame_size[0]), int(frame_size[1])],
+        source=source,
+    )
+    tmp_dir = f"{tracks_dir}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    with ColumnarWriter(tmp_dir, attrs) as writer:
+        if len(dets) > 0:
+            _write_track_rows(writer, dets, chunk_size)
+    del dets
+
+    shutil.rmtree(tracks_dir, ignore_errors=True)
+    os.replace(tmp_dir, tracks_dir)
+    shutil.rmtree(dets_dir)
+
+
+def _append_dets(writer: ColumnarWriter, idvs: list):
+    # same conversion as collect_human_tracking
+    if len(idvs) == 0:
+        return
+    bboxs = [np.array(idv["bbox"], dtype=np.float32)[:4] for idv in idvs]
+    kps = [np.array(idv["keypoints"], dtype=np.float32)[:, :2] for idv in idvs]
+    writer.append(
+        id=np.array([idv["id"] for idv in idvs], np.int64),
+        n_frame=np.array([idv["n_frame"] for idv in idvs], np.int64),
+        bbox=np.array(bboxs).reshape(-1, 2, 2),
+        keypoints=np.array(kps),
+    )
+
+
+def _write_track_rows(writer: ColumnarWriter, dets: dict, chunk_size: int):
+    ids = np.asarray(dets["id"])
+    n_frames = np.asarray(dets["n_frame"])
+    order = np.lexsort((n_frames, ids))
+    ids = ids[order]
+    n_frames = n_frames[order]
+
+    # span of each track from the first detection to the last one
+    track_ids, det_offsets, det_counts = np.unique(
+        ids, return_index=True, return_counts=True
+    )
+    first_frames = n_frames[det_offsets]
+    lengths = n_frames[det_offsets + det_counts - 1] - first_frames + 1
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    det_offsets = np.append(det_offsets, len(ids))
+
+    # row of each detection in the continuous time series
+    rows = np.repeat(offsets[:-1] - first_frames, det_counts) + n_frames
+
+    # write tracks in chunks of about chunk_size rows
+    n_tracks = len(track_ids)
+    bounds = np.searchsorted(offsets, np.arange(0, offsets[-1], chunk_size), "right")
+    bounds = np.unique(np.append(bounds - 1, n_tracks))
+    for k0, k1 in zip(bounds[:-1], bounds[1:]):
+        r0, r1 = offsets[k0], offsets[k1]
+        d0, d1 = det_offsets[k0], det_offsets[k1]
+        bboxs = np.full((r1 - r0, 2, 2), NAN_VALUE, np.float32)
+        kps = np.full((r1 - r0, 17, 2), NAN_VALUE, np.float32)
+        bboxs[rows[d0:d1] - r0] = dets["bbox"][order[d0:d1]]
+        kps[rows[d0:d1] - r0] = dets["keypoints"][order[d0:d1]]
+
+        lengths_chunk = lengths[k0:k1]
+        starts_chunk = np.repeat(offsets[k0:k1] - first_frames[k0:k1], lengths_chunk)
+        writer.append(
+            id=np.repeat(track_ids[k0:k1], lengths_chunk),
+            n_frame=np.arange(r0, r1) - starts_chunk,
+            bbox=bboxs,
+            keypoints=kps,
+        )
+
+
+class Tracks:
+    def __init__(self, tracks_dir: str):
+        attrs = load_attrs(tracks_dir)
+        self.video_name = attrs["video_name"]
+        self.frame_count = attrs["frame_count"]
+        self.frame_size = np.array(attrs["frame_size"])  # (h, w)
+
+        self.tracks_dir = tracks_dir
+        self._columns = None
+
+        # rows of each track are continuous and sorted by n_frame
+        ids = np.asarray(self.columns["id"])
+        self.track_ids, self.offsets, self.lengths = np.unique(
+            ids, return_index=True, return_counts=True
+        )
+        self.first_frames = np.asarray(self.columns["n_frame"])[self.offsets]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # memmaps are pickled with all of their data, reloaded in each process
+        state["_columns"] = None
+        return state
+
+    @property
+    def columns(self) -> dict:
+        if self._columns is None:
+            self._columns = load_columns(self.tracks_dir)
+            if len(self._columns) == 0:
+                # nobody has been detected in the video
+                self._columns = dict(
+                    id=np.empty((0,), np.int64),
+                    n_frame=np.empty((0,), np.int64),
+                    bbox=np.empty((0, 2, 2), np.float32),
+                    keypoints=np.empty((0, 17, 2), np.float32),
+                )
+        return self._columns
+
+    def __len__(self):
+        return len(self.track_ids)
+
+    def get_windows(self, seq_len: int, stride: int, th_nan_ratio: float = 0.3):
+        # windows of all tracks which pass the rules of cleansing_individual
+        # returns track indices, rows of the first frames, the window ends and
+        # the lengths of the windows
+        n_frames = np.asarray(self.columns["n_frame"])
+        bboxs = np.asarray(self.columns["bbox"]).reshape(-1, 4)
+        ends = np.arange(seq_len, self.frame_count + 1, stride)
+        starts = ends - seq_len
+
+        # windows are cut at the last frame where anyone is detected, as the
+        # length of the arrays made by individual_to_npz
+        is_detected = np.zeros(self.frame_count, bool)
+        is_detected[n_frames[np.any(bboxs > NAN_VALUE / 10, axis=1)]] = True
+        t = np.arange(self.frame_count)
+        last_detected = np.maximum.accumulate(np.where(is_detected, t, -1))
+        if len(ends) > 0:
+            win_lengths = last_detected[ends - 1] - starts + 1
+        else:
+            win_lengths = np.empty((0,), int)
+
+        # pairs of a track and a window starting within the span of the track
+        last_frames = self.first_frames + self.lengths - 1
+        win_lo = np.searchsorted(starts, self.first_frames, "left")
+        win_hi = np.searchsorted(starts, last_frames, "right")
+        counts = win_hi - win_lo
+        track_idxs = np.repeat(np.arange(len(self)), counts)
+        win_idxs = (
+            np.arange(counts.sum())
+            - np.repeat(np.cumsum(counts) - counts, counts)
+            + np.repeat(win_lo, counts)
+        )
+
+        # cleansing: the first and the last must be detected
+        is_valid = np.all(bboxs >= 0, axis=1)
+        lengths = win_lengths[win_idxs]
+        win_starts = starts[win_idxs]
+        rows = self.offsets[track_idxs] + win_starts - self.first_frames[track_idxs]
+        mask = (lengths > 0) & (win_starts + lengths - 1 <= last_frames[track_idxs])
+        last_rows = np.where(mask, rows + lengths - 1, rows)
+        mask &= is_valid[rows] & is_valid[last_rows]
+
+        # cleansing: the proportion of nan must be low
+        n_nans = np.concatenate([[0], np.cumsum(np.count_nonzero(bboxs < 0, axis=1))])
+        nan_ratio = (n_nans[last_rows + 1] - n_nans[rows]) / (
+            np.maximum(lengths, 1) * 2 * 2
+        )
+        mask &= nan_ratio < th_nan_ratio
+
+        track_idxs, rows, win_idxs = track_idxs[mask], rows[mask], win_idxs[mask]
+        order = np.lexsort((self.track_ids[track_idxs], win_idxs))
+        track_idxs, rows, win_idxs = track_idxs[order], rows[order], win_idxs[order]
+        return track_idxs, rows, ends[win_idxs], win_lengths[win_idxs]
+
+    def get_window(self, track_idx: int, row: int, seq_len: int):
+        # the frames out of the span of the track are nan
+        stop = min(row + seq_len, self.offsets[track_idx] + self.lengths[track_idx])
+        bboxs = np.full((seq_len, 2, 2), NAN_VALUE, np.float32)
+        kps = np.full((seq_len, 17, 2), NAN_VALUE, np.float32)
+        bboxs[: stop - row] = self.columns["bbox"][row:stop]
+        kps[: stop - row] = self.columns["keypoints"][row:stop]
+        return bboxs, kps
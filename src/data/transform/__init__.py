@@ -10,6 +10,8 @@ from .group import group_npz_to_tensor
 from .image import clip_images_by_bbox, images_to_tensor
 from .individual import (
     collect_human_tracking,
+    individual_collate_fn,
     individual_npz_to_tensor,
     individual_to_npz,
+    individual_to_tensor,
 )
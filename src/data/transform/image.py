@@ -4,10 +4,15 @@ import cv2
 import numpy as np
 
 
-def clip_images_by_bbox(frames, flows, human_tracking_data, resize):
+def clip_images_by_bbox(frames, flows, human_tracking_data, resize, frame_idxs=None):
+    # frame_idxs: indices of frames and flows for each time step,
+    # which allows to clip from a ring buffer without copying the whole window
+    if frame_idxs is None:
+        frame_idxs = range(len(human_tracking_data))
+
     idv_frames = []
     idv_flows = []
-    for t, idvs in enumerate(human_tracking_data):
+    for t, idvs in zip(frame_idxs, human_tracking_data):
         for idv in idvs:
             x1, y1, x2, y2 = list(map(int, idv["bbox"][:4]))
             idv_frames.append(cv2.resize(frames[t, y1:y2, x1:x2], resize))
@@ -1,29 +1,29 @@
 import io
+import itertools
 
 import numpy as np
 import torch
-from scipy import interpolate
+from torch.utils.data import default_collate
 
 
 def collect_human_tracking(human_tracking_data, unique_ids):
-    meta = []
-    ids = []
-    bboxs = []
-    kps = []
-    for t, idvs in enumerate(human_tracking_data):
-        for idv in idvs:
-            i = unique_ids.index(idv["id"])
-            meta.append([t, i])
-            ids.append(idv["id"])
-            bboxs.append(np.array(idv["bbox"], dtype=np.float32)[:4].reshape(2, 2))
-            kps.append(np.array(idv["keypoints"], dtype=np.float32)[:, :2])
-
-    return (
-        np.array(meta, np.uint16),
-        np.array(ids, np.uint16),
-        np.array(bboxs, np.float32),
-        np.array(kps, np.float32),
+    idvs = list(itertools.chain.from_iterable(human_tracking_data))
+    if len(idvs) == 0:
+        empty = np.array([], np.uint16)
+        return empty, empty, np.array([], np.float32), np.array([], np.float32)
+
+    t = np.repeat(
+        np.arange(len(human_tracking_data)), [len(x) for x in human_tracking_data]
     )
+    ids = np.array([idv["id"] for idv in idvs])
+    # index of each id in unique_ids
+    order = np.argsort(unique_ids, kind="stable")
+    i = order[np.searchsorted(np.asarray(unique_ids)[order], ids)]
+    meta = np.stack([t, i], axis=1)
+
+    bboxs = np.array([idv["bbox"][:4] for idv in idvs], np.float32).reshape(-1, 2, 2)
+    kps = np.array([idv["keypoints"] for idv in idvs], np.float32)[:, :, :2]
+    return meta.astype(np.uint16), ids.astype(np.uint16), bboxs, kps
 
 
 def individual_to_npz(
@@ -34,18 +34,16 @@ def individual_to_npz(
         h, w = frames.shape[1:3]
         frames_idvs = np.full((n, seq_len, h, w, 3), 0, dtype=np.uint8)
         flows_idvs = np.full((n, seq_len, h, w, 2), -1e10, dtype=np.float32)
-        for (t, i), frames_i, flows_i in zip(meta, frames, flows):
-            frames_idvs[i, t] = frames_i
-            flows_idvs[i, t] = flows_i
+        frames_idvs[meta[:, 1], meta[:, 0]] = frames
+        flows_idvs[meta[:, 1], meta[:, 0]] = flows
     else:
         frames_idvs = None
         flows_idvs = None
 
     bboxs_idvs = np.full((n, seq_len, 2, 2), -1e10, dtype=np.float32)
     kps_idvs = np.full((n, seq_len, 17, 2), -1e10, dtype=np.float32)
-    for (t, i), bboxs_i, kps_i in zip(meta, bboxs, kps):
-        bboxs_idvs[i, t] = bboxs_i
-        kps_idvs[i, t] = kps_i
+    bboxs_idvs[meta[:, 1], meta[:, 0]] = bboxs
+    kps_idvs[meta[:, 1], meta[:, 0]] = kps
 
     # cleansing
     unique_ids, frames_idvs, flows_idvs, bboxs_idvs, kps_idvs = cleansing_individual(
@@ -110,6 +108,7 @@ def individual_npz_to_tensor(
     mask_leg,
     range_points,
     load_frame_flow=False,
+    interpolate=True,
 ):
     key = sample["__key__"]
 
@@ -125,6 +124,46 @@ def individual_npz_to_tensor(
         frames = None
         flows = None
 
+    del sample, npz  # release memory
+
+    return individual_to_tensor(
+        key,
+        _id,
+        bboxs,
+        kps,
+        frame_size,
+        seq_len,
+        bbox_transform,
+        kps_transform,
+        mask_leg,
+        range_points,
+        interpolate,
+        frames,
+        flows,
+        frame_transform,
+        flow_transform,
+    )
+
+
+def individual_to_tensor(
+    key,
+    _id,
+    bboxs,
+    kps,
+    frame_size,
+    seq_len,
+    bbox_transform,
+    kps_transform,
+    mask_leg,
+    range_points,
+    interpolate=True,
+    frames=None,
+    flows=None,
+    frame_transform=None,
+    flow_transform=None,
+):
+    load_frame_flow = frames is not None and flows is not None
+
     if len(bboxs) < seq_len:
         # padding
         pad_shape = ((0, seq_len - len(bboxs)), (0, 0), (0, 0))
@@ -146,7 +185,9 @@ def individual_npz_to_tensor(
 
     kps[mask] = -1.0
     kps[~mask] = kps_transform(kps[~mask], bboxs[~mask], range_points)
-    kps = interpolate_points(kps, mask).reshape(seq_len, 17, 2)
+    if interpolate:
+        kps = interpolate_points(kps, mask)
+    kps = kps.reshape(seq_len, 17, 2)
     if mask_leg:
         kps = kps[:, :-4, :]
     kps = torch.from_numpy(kps).to(torch.float32)
@@ -155,10 +196,12 @@ def individual_npz_to_tensor(
     bboxs[~mask] = bbox_transform(
         bboxs[~mask], frame_size[::-1], range_points
     )  # frame_size: (h, w)
-    bboxs = interpolate_points(bboxs, mask).reshape(seq_len, 2, 2)
+    if interpolate:
+        bboxs = interpolate_points(bboxs, mask)
+    bboxs = bboxs.reshape(seq_len, 2, 2)
     bboxs = torch.from_numpy(bboxs).to(torch.float32)
 
-    del sample, npz, frames, flows  # release memory
+    del frames, flows  # release memory
 
     if pixcels is None:
         return key, _id, kps, bboxs, mask
@@ -166,16 +209,54 @@ def individual_npz_to_tensor(
         return key, _id, kps, bboxs, mask, pixcels
 
 
+def individual_collate_fn(samples):
+    # samples are not interpolated in individual_npz_to_tensor
+    batch = list(default_collate(samples))
+    mask = batch[4]
+    batch[2] = interpolate_points_batch(batch[2], mask)  # kps
+    batch[3] = interpolate_points_batch(batch[3], mask)  # bbox
+    return batch
+
+
 def interpolate_points(vals, mask):
     seq_len = vals.shape[0]
+    vals = torch.from_numpy(vals.reshape(1, seq_len, -1))
+    mask = torch.as_tensor(mask).view(1, seq_len)
+    return interpolate_points_batch(vals, mask)[0].numpy()
 
-    # interpolate
-    new_vals = vals.copy().reshape(seq_len, -1)
-    x = np.arange(seq_len)[~mask]
-    vals = vals.reshape(seq_len, -1)
-    curve = interpolate.interp1d(
-        x, vals[~mask], kind="linear", axis=0, fill_value="extrapolate"
-    )
-    new_vals[mask] = curve(np.arange(seq_len))[mask].astype(vals.dtype)
 
-    return new_vals
+def interpolate_points_batch(vals, mask):
+    # linear interpolation with extrapolation by the edge segments
+    # vals: (b, seq_len, ...), mask: (b, seq_len), True at missing steps
+    b, seq_len = mask.shape
+    shape = vals.shape
+    vals = vals.reshape(b, seq_len, -1)
+
+    t = torch.arange(seq_len, device=mask.device).expand(b, seq_len)
+    # nearest valid step before and after each step
+    prev_t = torch.where(mask, -1, t).cummax(dim=1).values
+    next_t = torch.where(mask, seq_len, t).flip(1).cummin(dim=1).values.flip(1)
+
+    # use two valid steps at the edge for extrapolation
+    first_t = next_t[:, :1].expand(b, seq_len)
+    second_t = next_t.gather(1, (first_t + 1).clamp(max=seq_len - 1))
+    last_t = prev_t[:, -1:].expand(b, seq_len)
+    second_last_t = prev_t.gather(1, (last_t - 1).clamp(min=0))
+    is_head = prev_t < 0
+    is_tail = next_t >= seq_len
+    lo = torch.where(is_head, first_t, torch.where(is_tail, second_last_t, prev_t))
+    hi = torch.where(is_head, second_t, torch.where(is_tail, last_t, next_t))
+    # only one valid step in the sequence
+    lo = torch.where((lo < 0) | (lo >= seq_len), hi, lo)
+    hi = torch.where((hi < 0) | (hi >= seq_len), lo, hi)
+    lo = lo.clamp(0, seq_len - 1)
+    hi = hi.clamp(0, seq_len - 1)
+
+    vals_lo = vals.gather(1, lo[..., None].expand_as(vals))
+    vals_hi = vals.gather(1, hi[..., None].expand_as(vals))
+    dt = (hi - lo).to(vals.dtype)
+    w = torch.where(dt != 0, (t - lo).to(vals.dtype) / dt.clamp(min=1), 0.0)
+    new_vals = vals_lo + w[..., None] * (vals_hi - vals_lo)
+
+    new_vals = torch.where(mask[..., None], new_vals, vals)
+    return new_vals.reshape(shape)
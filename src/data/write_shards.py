@@ -1,21 +1,34 @@
-import copy
 import functools
 import gc
 import itertools
 import os
-import time
+import re
 import warnings
 from types import SimpleNamespace
 
 warnings.filterwarnings("ignore")
 import numpy as np
-from torch.multiprocessing import Pool, set_start_method
+from torch.multiprocessing import Manager, Pool, set_start_method
 from tqdm import tqdm
 
 from src.model import HumanTracking
 from src.utils import json_handler, video
 
-from .obj import ShardWritingManager, SharedNDArray, SharedShardWriter
+from .manifest import ShardManifest, calc_fingerprint
+from .obj import (
+    ShardWritingManager,
+    SharedNDArray,
+    DirectShardWriter,
+    SharedShardRegistry,
+    WindowShardWriter,
+)
+from .tracking_store import (
+    TrackingReader,
+    TrackingWriter,
+    get_tracking_dir,
+    has_tracking,
+)
+from .tracks import Tracks, get_tracks_dir, is_tracks_updated, write_tracks
 from .transform import clip_images_by_bbox, collect_human_tracking, individual_to_npz
 
 set_start_method("spawn", force=True)
@@ -28,174 +41,575 @@ def write_shards(
     model_ht: HumanTracking = None,
     n_processes: int = None,
     skip_optical_flow: bool = False,
+    max_windows_in_flight: int = 4,
+    config_ht: SimpleNamespace = None,
+    in_process: bool = False,
+    tracks_only: bool = False,
 ):
+    # in_process: all stages run in the calling process without a pool
+    # tracks_only: only the tracks store is written for IndividualDatasetTracks
     if n_processes is None:
         n_processes = os.cpu_count()
 
-    data_root = os.path.dirname(video_path)
-    video_name = os.path.basename(video_path).split(".")[0]
-    dir_path = os.path.join(data_root, video_name)
-
-    json_path = os.path.join(dir_path, "json", "pose.json")
-
+    video_name, json_path, shard_pattern = _get_paths(video_path, dataset_type, config)
     shard_maxcount = float(config.max_shard_count)
     seq_len = int(config.seq_len)
     stride = int(config.stride)
     h, w = config.img_size
-    shard_pattern = (
-        f"{dataset_type}-seq_len{seq_len}-stride{stride}-{h}x{w}" + "-%06d.tar"
+
+    # human tracking runs only once for each video and human_tracking.yaml,
+    # the results are reused without the model
+    if config_ht is None and model_ht is not None:
+        config_ht = model_ht.config
+    if config_ht is not None:
+        tracking_dir = get_tracking_dir(video_path, config_ht)
+    else:
+        tracking_dir = None
+
+    if tracks_only:
+        if not has_tracking(tracking_dir) and not os.path.exists(json_path):
+            # tracking only, no windows are written
+            _write_windows_in_process(
+                video_path,
+                model_ht,
+                tracking_dir,
+                json_path,
+                None,
+                set(),
+                video_name,
+                dataset_type,
+                seq_len,
+                stride,
+                (w, h),
+                True,
+                True,
+            )
+        _write_tracks(video_path, tracking_dir, json_path)
+        return
+
+    # skip finished video and windows
+    manifest = _load_manifest(
+        video_path, shard_pattern, dataset_type, config, skip_optical_flow
     )
+    if manifest.is_completed:
+        _write_tracks(video_path, tracking_dir, json_path)
+        return
+    completed_windows = manifest.completed_windows
 
-    shard_pattern = os.path.join(dir_path, "shards", shard_pattern)
-    os.makedirs(os.path.dirname(shard_pattern), exist_ok=True)
+    do_human_tracking = not has_tracking(tracking_dir) and not os.path.exists(
+        json_path
+    )
+    do_decoding = not skip_optical_flow or do_human_tracking
+    if not do_decoding and dataset_type == "individual":
+        # nothing is needed from the video, all windows are built at once
+        tracks_dir = _write_tracks(video_path, tracking_dir, json_path)
+        _write_shards_from_tracks(
+            tracks_dir, shard_pattern, shard_maxcount, manifest, seq_len, stride
+        )
+        return
+
+    if in_process:
+        sink = WindowShardWriter(shard_pattern, shard_maxcount, manifest)
+        _write_windows_in_process(
+            video_path,
+            model_ht,
+            tracking_dir,
+            json_path,
+            sink,
+            completed_windows,
+            video_name,
+            dataset_type,
+            seq_len,
+            stride,
+            (w, h),
+            skip_optical_flow,
+            do_human_tracking,
+        )
+        sink.close()
+    else:
+        _write_windows_parallel(
+            video_path,
+            model_ht,
+            tracking_dir,
+            json_path,
+            shard_pattern,
+            shard_maxcount,
+            manifest,
+            completed_windows,
+            video_name,
+            dataset_type,
+            seq_len,
+            stride,
+            (w, h),
+            skip_optical_flow,
+            do_human_tracking,
+            n_processes,
+            max_windows_in_flight,
+        )
+    manifest.set_completed()
+
+    _write_tracks(video_path, tracking_dir, json_path)
+    gc.collect()
+
+
+def _write_windows_parallel(
+    video_path,
+    model_ht,
+    tracking_dir,
+    json_path,
+    shard_pattern,
+    shard_maxcount,
+    manifest,
+    completed_windows,
+    video_name,
+    dataset_type,
+    seq_len,
+    stride,
+    resize,
+    skip_optical_flow,
+    do_human_tracking,
+    n_processes,
+    max_windows_in_flight,
+):
+    # the ring holds every frame of the windows which can be in flight at once
+    que_len = seq_len + stride * (max_windows_in_flight - 1)
+
+    # frames are decoded inside each worker, the manager carries only control data
+    cap = video.Capture(video_path)
+    frame_count, frame_size = cap.get_frame_count(), cap.get_size()
+    del cap
+
+    # frames are decoded only once by the frame source and shared by reference
+    do_decoding = not skip_optical_flow or do_human_tracking
 
     ShardWritingManager.register("Tqdm", tqdm)
-    ShardWritingManager.register("Capture", video.Capture)
-    ShardWritingManager.register("SharedShardWriter", SharedShardWriter)
+    ShardWritingManager.register("SharedShardRegistry", SharedShardRegistry)
     with Pool(n_processes) as pool, ShardWritingManager() as swm:
         async_results = []
-        lock = swm.Lock()
-        cap_of = swm.Capture(video_path)
-        cap_ht = swm.Capture(video_path)
-        frame_count, frame_size = cap_of.get_frame_count(), cap_of.get_size()
+        cond = swm.Condition()
+        # head: the first frame which is still referred by window builders
         head = swm.Value("i", 0)
+        finished_windows = swm.dict()
 
         # create progress bars
+        if do_decoding:
+            pbar_fr = swm.Tqdm(
+                total=frame_count, desc="decoding", position=1, leave=False, ncols=100
+            )
         if not skip_optical_flow:
             pbar_of = swm.Tqdm(
                 total=frame_count,
                 desc="opticalflow",
-                position=1,
+                position=2,
                 leave=False,
                 ncols=100,
             )
         pbar_ht = swm.Tqdm(
-            total=frame_count, desc="tracking", position=2, leave=False, ncols=100
+            total=frame_count, desc="tracking", position=3, leave=False, ncols=100
         )
         total = (frame_count - seq_len) // stride + 1
         pbar_w = swm.Tqdm(
-            total=total, desc="writing", position=3, leave=False, ncols=100
+            total=total, desc="writing", position=4, leave=False, ncols=100
         )
 
-        # create shared ndarray and start optical flow
-        if not skip_optical_flow:
-            shape = (seq_len, frame_size[1], frame_size[0], 3)
+        # create shared ndarrays
+        # tail: the number of frames which have been written into each ring
+        if do_decoding:
+            shape = (que_len, frame_size[1], frame_size[0], 3)
             frame_sna = SharedNDArray(f"frame_{dataset_type}", shape, np.uint8)
-            shape = (seq_len, frame_size[1], frame_size[0], 2)
+            tail_fr = swm.Value("i", 0)
+        else:
+            frame_sna = None
+            tail_fr = None
+        if not skip_optical_flow:
+            shape = (que_len, frame_size[1], frame_size[0], 2)
             flow_sna = SharedNDArray(f"flow_{dataset_type}", shape, np.float32)
             tail_of = swm.Value("i", 0)
+        else:
+            flow_sna = None
+            tail_of = None
+        tail_ht = swm.Value("i", 0)
+
+        # start frame source
+        if do_decoding:
+            cursors_f = functools.partial(
+                _get_consumer_cursor,
+                head=head,
+                tail_of=tail_of,
+                tail_ht=tail_ht if do_human_tracking else None,
+            )
+            ec = functools.partial(_error_callback, *("_decode_async",))
+            result = pool.apply_async(
+                _decode_async,
+                (video_path, frame_sna, tail_fr, cursors_f, cond, pbar_fr),
+                error_callback=ec,
+            )
+            async_results.append(result)
+
+        # start optical flow
+        if not skip_optical_flow:
             ec = functools.partial(_error_callback, *("_optical_flow_async",))
             result = pool.apply_async(
                 _optical_flow_async,
-                (cap_of, frame_sna, flow_sna, tail_of, head, lock, pbar_of),
+                (frame_count, frame_sna, flow_sna, tail_fr, tail_of, cond, pbar_of),
                 error_callback=ec,
             )
             async_results.append(result)
-        else:
-            frame_sna = None
-            flow_sna = None
-            tail_of = None
 
         # create shared list of indiciduals and start human tracking
-        ht_que = swm.list([[] for _ in range(seq_len)])
-        n_frames_que = swm.list([-1 for _ in range(seq_len)])
-        tail_ht = swm.Value("i", 0)
+        ht_que = swm.list([[] for _ in range(que_len)])
+        n_frames_que = swm.list([-1 for _ in range(que_len)])
         ec = functools.partial(_error_callback, *("_human_tracking_async",))
         result = pool.apply_async(
             _human_tracking_async,
             (
-                cap_ht,
+                frame_count,
+                frame_sna if do_human_tracking else None,
                 json_path,
+                tracking_dir,
                 model_ht,
                 ht_que,
                 n_frames_que,
+                tail_fr,
                 tail_ht,
                 head,
-                lock,
+                cond,
                 pbar_ht,
+                que_len - seq_len + 1,
             ),
             error_callback=ec,
         )
         async_results.append(result)
 
-        # create shard writer and start writing
-        sink = swm.SharedShardWriter(shard_pattern, maxcount=shard_maxcount, verbose=0)
-        ec = functools.partial(_error_callback, *("SharedShardWriter.write_async",))
-        write_async_result = pool.apply_async(sink.write_async, error_callback=ec)
-        async_results.append(write_async_result)
-        arr_write_que_async_f = functools.partial(
-            _add_write_que_async,
+        # each worker writes its own shards, shard numbers and the manifest are
+        # shared by the registry
+        registry = swm.SharedShardRegistry(manifest)
+        write_window_async_f = functools.partial(
+            _write_window_async,
             n_frames_que=n_frames_que,
             frame_size=frame_size,
-            frame_sna=frame_sna,
+            frame_sna=frame_sna if not skip_optical_flow else None,
             flow_sna=flow_sna,
             ht_que=ht_que,
             head=head,
-            sink=sink,
-            lock=lock,
+            finished_windows=finished_windows,
+            shard_pattern=shard_pattern,
+            shard_maxcount=shard_maxcount,
+            registry=registry,
+            cond=cond,
             pbar=pbar_w,
             video_name=video_name,
             dataset_type=dataset_type,
             seq_len=seq_len,
             stride=stride,
-            resize=(w, h),
+            resize=resize,
         )
-        check_full_f = functools.partial(
-            _check_full,
-            tail_of=tail_of,
-            tail_ht=tail_ht,
-            head=head,
-            que_len=seq_len,
-        )
-        ec = functools.partial(_error_callback, *("_add_write_que_async",))
+        ec = functools.partial(_error_callback, *("_write_window_async",))
 
         for n_frame in range(seq_len, frame_count + 1, stride):
-            while not check_full_f():
-                async_results = _monitoring_async_tasks(async_results)
-                time.sleep(0.01)
-
-            while n_frame != n_frames_que[tail_ht.value] + 1:
+            if n_frame in completed_windows:
+                # nobody refers to the frames of this window
+                _release_window(n_frame, head, finished_windows, cond, seq_len, stride)
+                pbar_w.update()
+                continue
+
+            # wake up as soon as all stages have filled the frames of this window
+            is_ready_f = functools.partial(
+                _is_window_ready, n_frame=n_frame, tail_of=tail_of, tail_ht=tail_ht
+            )
+            while True:
+                with cond:
+                    if cond.wait_for(is_ready_f, timeout=1.0):
+                        break
                 async_results = _monitoring_async_tasks(async_results)
-                time.sleep(0.1)  # waiting for shared memory has been updated
-            time.sleep(0.1)  # after delay
 
-            # create and add data in write que
+            # create and write samples of the window
             result = pool.apply_async(
-                arr_write_que_async_f, (n_frame,), error_callback=ec
+                write_window_async_f, (n_frame,), error_callback=ec
             )
             async_results.append(result)
-
-            sleep_count = 0
-            while check_full_f():
-                async_results = _monitoring_async_tasks(async_results)
-                time.sleep(0.01)  # waiting for coping queue in _add_write_que_async
-                sleep_count += 1
-                if sleep_count > 60 * 3 / 0.01:
-                    break  # exit infinite loop after 3 min
-
-        while [r.ready() for r in async_results].count(False) > 0:
             async_results = _monitoring_async_tasks(async_results)
-            time.sleep(0.01)  # waiting for adding write queue
 
-        # finish and waiting for complete writing
-        sink.set_finish_writing()
-        while not write_async_result.ready():
-            async_results = _monitoring_async_tasks(async_results)
-            time.sleep(0.01)
-        sink.close()
+        # waiting for writing all windows
+        for result in async_results:
+            result.get()
+
+        # close the last shards of all workers
+        barrier = swm.Barrier(n_processes)
+        pool.map(_close_worker_sink, [barrier] * n_processes, chunksize=1)
 
         # close and unlink shared memories
-        if not skip_optical_flow:
+        if do_decoding:
             frame_sna.unlink()
+        if not skip_optical_flow:
             flow_sna.unlink()
 
+        if do_decoding:
+            pbar_fr.close()
         if not skip_optical_flow:
             pbar_of.close()
         pbar_ht.close()
         pbar_w.close()
+
+
+def write_shards_parallel(
+    video_paths: list,
+    dataset_type: str,
+    config: SimpleNamespace,
+    config_ht: SimpleNamespace,
+    devices: list,
+    n_workers: int,
+    skip_optical_flow: bool = False,
+    tracks_only: bool = False,
+):
+    # sort videos to start from the longest one
+    frame_counts = [video.Capture(path).get_frame_count() for path in video_paths]
+    video_paths = [
+        path
+        for _, path in sorted(zip(frame_counts, video_paths), key=lambda x: -x[0])
+    ]
+
+    with Manager() as manager:
+        device_que = manager.Queue()
+        for i in range(n_workers):
+            device_que.put(devices[i % len(devices)])
+
+        write_shards_f = functools.partial(
+            _write_shards_worker,
+            dataset_type=dataset_type,
+            config=config,
+            skip_optical_flow=skip_optical_flow,
+            tracks_only=tracks_only,
+        )
+        with Pool(
+            n_workers, initializer=_init_worker, initargs=(config_ht, device_que)
+        ) as pool:
+            results = pool.imap_unordered(write_shards_f, video_paths, chunksize=1)
+            for _ in tqdm(results, total=len(video_paths), ncols=100, position=0):
+                pass
+
+
+_worker_config_ht = None
+_worker_device = None
+_worker_model_ht = None
+
+
+def _init_worker(config_ht, device_que):
+    global _worker_config_ht, _worker_device
+    _worker_config_ht = config_ht
+    _worker_device = device_que.get()
+
+
+def _write_shards_worker(
+    video_path, dataset_type, config, skip_optical_flow, tracks_only
+):
+    global _worker_model_ht
+    _, json_path, _ = _get_paths(video_path, dataset_type, config)
+    tracking_dir = get_tracking_dir(video_path, _worker_config_ht)
+    if not has_tracking(tracking_dir) and not os.path.exists(json_path):
+        # the tracker is created once and kept during the lifetime of the worker
+        if _worker_model_ht is None:
+            _worker_model_ht = HumanTracking(_worker_config_ht, _worker_device)
+        _worker_model_ht.reset_tracker()
+
+    write_shards(
+        video_path,
+        dataset_type,
+        config,
+        _worker_model_ht,
+        skip_optical_flow=skip_optical_flow,
+        config_ht=_worker_config_ht,
+        in_process=True,
+        tracks_only=tracks_only,
+    )
     gc.collect()
 
 
+def _write_windows_in_process(
+    video_path,
+    model_ht,
+    tracking_dir,
+    json_path,
+    sink,
+    completed_windows,
+    video_name,
+    dataset_type,
+    seq_len,
+    stride,
+    resize,
+    skip_optical_flow,
+    do_human_tracking,
+):
+    # single process version of the pipeline with local rings,
+    # windows are not written when sink is None
+    cap = video.Capture(video_path)
+    frame_count, frame_size = cap.get_frame_count(), cap.get_size()
+    do_decoding = not skip_optical_flow or do_human_tracking
+
+    # frames are detected in batches as same as _human_tracking_async
+    if do_human_tracking:
+        batch_size = model_ht.batch_size
+        tracking_writer = TrackingWriter(tracking_dir)
+    else:
+        batch_size = 1
+        idvs_iter = _iter_idvs(tracking_dir, json_path, frame_count)
+
+    # local rings for the latest seq_len frames
+    if not skip_optical_flow:
+        frame_que = np.empty((seq_len, frame_size[1], frame_size[0], 3), np.uint8)
+        flow_que = np.empty((seq_len, frame_size[1], frame_size[0], 2), np.float32)
+    ht_que = [[] for _ in range(seq_len)]
+
+    prev_frame = None
+    for n_frame_batch in range(0, frame_count, batch_size):
+        n_frames = range(n_frame_batch, min(n_frame_batch + batch_size, frame_count))
+        if do_decoding:
+            frames = [cap.read()[1] for _ in n_frames]
+        if do_human_tracking:
+            idvs_batch = model_ht.predict_batch(frames, n_frames)
+            for idvs_tmp in idvs_batch:
+                tracking_writer.write(idvs_tmp)
+        else:
+            idvs_batch = [next(idvs_iter) for _ in n_frames]
+
+        for i, n_frame in enumerate(n_frames):
+            if not skip_optical_flow:
+                frame = frames[i]
+                if prev_frame is None:
+                    y, x = frame.shape[:2]
+                    flow = np.zeros((y, x, 2), np.float32)
+                else:
+                    flow = video.optical_flow(prev_frame, frame)
+                prev_frame = frame
+                frame_que[n_frame % seq_len] = frame
+                flow_que[n_frame % seq_len] = flow
+            ht_que[n_frame % seq_len] = idvs_batch[i]
+            if sink is None:
+                continue
+
+            n_frame_window = n_frame + 1
+            if n_frame_window < seq_len or (n_frame_window - seq_len) % stride != 0:
+                continue
+            if n_frame_window in completed_windows:
+                continue
+
+            window_idxs = np.arange(n_frame_window - seq_len, n_frame_window) % seq_len
+            ht_window = [ht_que[idx] for idx in window_idxs]
+            if not skip_optical_flow:
+                idv_frames, idv_flows = clip_images_by_bbox(
+                    frame_que, flow_que, ht_window, resize, window_idxs
+                )
+            else:
+                idv_frames = None
+                idv_flows = None
+
+            samples = _create_window_samples(
+                n_frame_window,
+                ht_window,
+                idv_frames,
+                idv_flows,
+                frame_size,
+                video_name,
+                dataset_type,
+            )
+            sink.write_window(n_frame_window, samples)
+
+    if do_human_tracking:
+        tracking_writer.close()
+    del cap
+
+
+def _write_tracks(video_path, tracking_dir, json_path):
+    # continuous time series of each track, IndividualDatasetTracks slices the
+    # windows of any seq_len and stride from it
+    if has_tracking(tracking_dir):
+        source = os.path.basename(tracking_dir)
+    elif os.path.exists(json_path):
+        source = "pose.json-{}-{}".format(
+            os.path.getsize(json_path), os.path.getmtime(json_path)
+        )
+    else:
+        return None
+
+    data_dir = os.path.dirname(os.path.dirname(json_path))
+    tracks_dir = get_tracks_dir(data_dir)
+    if is_tracks_updated(tracks_dir, source):
+        return tracks_dir
+
+    video_name = os.path.basename(video_path).split(".")[0]
+    cap = video.Capture(video_path)
+    frame_count, frame_size = cap.get_frame_count(), cap.get_size()
+    del cap
+
+    idvs_iter = _iter_idvs(tracking_dir, json_path, frame_count)
+    frame_size = (frame_size[1], frame_size[0])  # (h, w)
+    write_tracks(tracks_dir, idvs_iter, video_name, frame_count, frame_size, source)
+    return tracks_dir
+
+
+def _write_shards_from_tracks(
+    tracks_dir, shard_pattern, shard_maxcount, manifest, seq_len, stride
+):
+    # valid windows of all tracks are found at once, and each sample is a view
+    # of the time series of a track
+    tracks = Tracks(tracks_dir)
+    track_idxs, rows, n_frames, lengths = tracks.get_windows(seq_len, stride)
+    completed_windows = manifest.completed_windows
+
+    sink = WindowShardWriter(shard_pattern, shard_maxcount, manifest)
+    for n_frame in range(seq_len, tracks.frame_count + 1, stride):
+        if n_frame in completed_windows:
+            continue
+
+        samples = []
+        lo, hi = np.searchsorted(n_frames, [n_frame, n_frame + 1])
+        for i in range(lo, hi):
+            _id = tracks.track_ids[track_idxs[i]]
+            row, length = rows[i], lengths[i]
+            npz = {
+                "id": np.array(_id),
+                "bbox": tracks.columns["bbox"][row : row + length],
+                "keypoints": tracks.columns["keypoints"][row : row + length],
+                "frame_size": tracks.frame_size,  # (h, w)
+            }
+            key = f"{tracks.video_name}_{n_frame}_{_id}"
+            samples.append({"__key__": key, "npz": npz})
+        sink.write_window(n_frame, samples)
+
+    sink.close()
+    manifest.set_completed()
+
+
+def _load_manifest(video_path, shard_pattern, dataset_type, config, skip_optical_flow):
+    fingerprint = calc_fingerprint(
+        video_path,
+        config,
+        dataset_type=dataset_type,
+        skip_optical_flow=skip_optical_flow,
+    )
+    return ShardManifest(shard_pattern, fingerprint, int(config.stride))
+
+
+def _get_paths(video_path, dataset_type, config):
+    data_root = os.path.dirname(video_path)
+    video_name = os.path.basename(video_path).split(".")[0]
+    dir_path = os.path.join(data_root, video_name)
+
+    json_path = os.path.join(dir_path, "json", "pose.json")
+
+    seq_len = int(config.seq_len)
+    stride = int(config.stride)
+    h, w = config.img_size
+    shard_pattern = (
+        f"{dataset_type}-seq_len{seq_len}-stride{stride}-{h}x{w}" + "-%06d.tar"
+    )
+
+    shard_pattern = os.path.join(dir_path, "shards", shard_pattern)
+    os.makedirs(os.path.dirname(shard_pattern), exist_ok=True)
+
+    return video_name, json_path, shard_pattern
+
+
 def _monitoring_async_tasks(async_results):
     proceeding_thred_idxs = []
     for i, result in enumerate(async_results):
@@ -213,88 +627,235 @@ def _error_callback(*args):
     print(f"Error occurred in {args[0]}:\n{args[1:]}")
 
 
-def _check_full(tail_of, tail_ht, head, que_len):
-    if tail_of is not None:
-        is_frame_que_full = (tail_of.value + 1) % que_len == head.value
-    else:
-        is_frame_que_full = True
-    is_idv_que_full = (tail_ht.value + 1) % que_len == head.value
-    is_eq = tail_of.value == tail_ht.value if tail_of is not None else True
-    return is_frame_que_full and is_idv_que_full and is_eq
+def _is_window_ready(n_frame, tail_of, tail_ht):
+    is_frame_ready = tail_of.value >= n_frame if tail_of is not None else True
+    return is_frame_ready and tail_ht.value >= n_frame
+
+
+def _wait_for_vacancy(n_frame, head, que_len, cond):
+    # block until the slot of n_frame has been released by all window builders
+    with cond:
+        cond.wait_for(lambda: n_frame < head.value + que_len)
 
 
-def _optical_flow_async(cap, frame_sna, flow_sna, tail_of, head, lock, pbar):
+def _wait_for_frame(n_frame, tail_fr, cond):
+    with cond:
+        cond.wait_for(lambda: n_frame < tail_fr.value)
+
+
+def _advance_tail(n_frame, tail, cond):
+    with cond:
+        tail.value = n_frame + 1
+        cond.notify_all()
+
+
+def _get_consumer_cursor(head, tail_of, tail_ht):
+    # the first frame in the ring which is still referred by any consumer
+    cursors = [head.value]
+    if tail_of is not None:
+        cursors.append(tail_of.value - 1)  # the previous frame for optical flow
+    if tail_ht is not None:
+        cursors.append(tail_ht.value)
+    return max(min(cursors), 0)
+
+
+def _release_window(n_frame, head, finished_windows, cond, seq_len, stride):
+    # windows may finish out of order, so head only proceeds over the
+    # consecutive finished windows from the oldest one
+    with cond:
+        finished_windows[n_frame] = True
+        head_val = head.value
+        while head_val + seq_len in finished_windows:
+            del finished_windows[head_val + seq_len]
+            head_val += stride
+        head.value = head_val
+        cond.notify_all()
+
+
+def _decode_async(video_path, frame_sna, tail_fr, cursors_f, cond, pbar):
+    cap = video.Capture(video_path)
     frame_que, frame_shm = frame_sna.ndarray()
-    flow_que, flow_shm = flow_sna.ndarray()
     que_len = frame_que.shape[0]
 
     frame_count = cap.get_frame_count()
-    prev_frame = cap.read(0)[1]
-    cap.set_pos_frame_count(0)  # reset read position
-
-    frame_que[tail_of.value] = prev_frame
-    y, x = prev_frame.shape[:2]
-    flow_que[tail_of.value] = np.zeros((y, x, 2), np.float32)
-    tail_of.value = 1
-    pbar.update()
-
-    for n_frame in range(1, frame_count):
+    for n_frame in range(frame_count):
         frame = cap.read()[1]
-        flow = video.optical_flow(prev_frame, frame)
-        prev_frame = frame
 
-        with lock:
-            frame_que[tail_of.value] = frame
-            flow_que[tail_of.value] = flow
+        # backpressure from the slowest consumer
+        with cond:
+            cond.wait_for(lambda: n_frame < cursors_f() + que_len)
+        frame_que[n_frame % que_len] = frame
+        _advance_tail(n_frame, tail_fr, cond)
         pbar.update()
 
-        if n_frame + 1 == frame_count:
-            break  # finish
+    del cap, frame_que
+    frame_shm.close()
 
-        next_tail = (tail_of.value + 1) % que_len
-        while next_tail == head.value:
-            time.sleep(0.001)
-        tail_of.value = next_tail
 
+def _optical_flow_async(
+    frame_count, frame_sna, flow_sna, tail_fr, tail_of, cond, pbar
+):
+    frame_que, frame_shm = frame_sna.ndarray()
+    flow_que, flow_shm = flow_sna.ndarray()
+    que_len = frame_que.shape[0]
+
+    frame = prev_frame = None
+    for n_frame in range(frame_count):
+        _wait_for_frame(n_frame, tail_fr, cond)
+        frame = frame_que[n_frame % que_len]
+        if n_frame == 0:
+            y, x = frame.shape[:2]
+            flow = np.zeros((y, x, 2), np.float32)
+        else:
+            prev_frame = frame_que[(n_frame - 1) % que_len]
+            flow = video.optical_flow(prev_frame, frame)
+
+        # the slot of flow has been released since the frame has been decoded
+        flow_que[n_frame % que_len] = flow
+        _advance_tail(n_frame, tail_of, cond)
+        pbar.update()
+
+    del frame, prev_frame, frame_que, flow_que
     frame_shm.close()
     flow_shm.close()
-    del cap, frame_que, flow_que
 
 
 def _human_tracking_async(
-    cap, json_path, model, ht_que, n_frames_que, tail_ht, head, lock, pbar
+    frame_count,
+    frame_sna,
+    json_path,
+    tracking_dir,
+    model,
+    ht_que,
+    n_frames_que,
+    tail_fr,
+    tail_ht,
+    head,
+    cond,
+    pbar,
+    max_batch_size,
 ):
     que_len = len(ht_que)
 
-    do_human_tracking = not os.path.exists(json_path)
-    if not do_human_tracking:
-        json_data = json_handler.load(json_path)
+    do_human_tracking = frame_sna is not None
+    if do_human_tracking:
+        frame_que, frame_shm = frame_sna.ndarray()
+        frames = None
+        tracking_writer = TrackingWriter(tracking_dir)
+    else:
+        idvs_iter = _iter_idvs(tracking_dir, json_path, frame_count)
 
-    frame_count = cap.get_frame_count()
-    for n_frame in range(frame_count):
+    # frames are detected in batches, the ring keeps the frames of a batch
+    # until tail_ht passes them. a batch must fit in the vacancy of the ring
+    # beyond the oldest window which waits for tracking
+    if do_human_tracking:
+        batch_size = min(model.batch_size, max_batch_size)
+    else:
+        batch_size = 1
+    for n_frame_batch in range(0, frame_count, batch_size):
+        n_frames = range(n_frame_batch, min(n_frame_batch + batch_size, frame_count))
         if do_human_tracking:
-            frame = cap.read()[1]
-            idvs_tmp = model.predict(frame, n_frame)
+            _wait_for_frame(n_frames[-1], tail_fr, cond)
+            frames = [frame_que[n_frame % que_len] for n_frame in n_frames]
+            idvs_batch = model.predict_batch(frames, n_frames)
+            for idvs_tmp in idvs_batch:
+                tracking_writer.write(idvs_tmp)
         else:
-            idvs_tmp = [idv for idv in json_data if idv["n_frame"] == n_frame]
+            idvs_batch = [next(idvs_iter) for _ in n_frames]
 
-        with lock:
-            ht_que[tail_ht.value] = idvs_tmp
-            n_frames_que[tail_ht.value] = n_frame
+        for n_frame, idvs_tmp in zip(n_frames, idvs_batch):
+            _wait_for_vacancy(n_frame, head, que_len, cond)
+            ht_que[n_frame % que_len] = idvs_tmp
+            n_frames_que[n_frame % que_len] = n_frame
+            _advance_tail(n_frame, tail_ht, cond)
             pbar.update()
 
-        if n_frame + 1 == frame_count:
-            break  # finish
-
-        next_tail = (tail_ht.value + 1) % que_len
-        while next_tail == head.value:
-            time.sleep(0.001)
-        tail_ht.value = next_tail
+    if do_human_tracking:
+        tracking_writer.close()
+        del frames, frame_que
+        frame_shm.close()
 
-    del cap
 
+def _iter_idvs(tracking_dir, json_path, frame_count):
+    # the tracking store is preferred to pose.json
+    if has_tracking(tracking_dir):
+        return TrackingReader(tracking_dir).iter_frames(frame_count)
+    else:
+        return _iter_idvs_from_json(json_path, frame_count)
+
+
+def _iter_idvs_from_json(json_path, frame_count):
+    # pose.json is streamed and grouped by frame
+    idvs_json = json_handler.iter_list(json_path)
+    if not _is_sorted_by_n_frame(json_path):
+        # grouped in one pass, all individuals are kept in memory
+        idvs_frames = [[] for _ in range(frame_count)]
+        for idv in idvs_json:
+            if idv["n_frame"] < frame_count:
+                idvs_frames[idv["n_frame"]].append(idv)
+        yield from idvs_frames
+        return
 
-def _add_write_que_async(
+    # only the current frame is kept in memory
+    idv = next(idvs_json, None)
+    for n_frame in range(frame_count):
+        idvs_tmp = []
+        while idv is not None and idv["n_frame"] <= n_frame:
+            if idv["n_frame"] < n_frame:
+                raise ValueError(f"{json_path} is not sorted by n_frame")
+            idvs_tmp.append(idv)
+            idv = next(idvs_json, None)
+        yield idvs_tmp
+
+
+_N_FRAME_PATTERN = re.compile(rb'"n_frame"\s*:\s*(\d+)')
+
+
+def _is_sorted_by_n_frame(json_path, chunk_size=1 << 24):
+    # n_frame is scanned in the raw bytes, which is much faster than decoding
+    prev_n_frame = -1
+    buf = b""
+    with open(json_path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            is_eof = chunk == b""
+            buf += chunk
+            end = 0
+            for match in _N_FRAME_PATTERN.finditer(buf):
+                if match.end() == len(buf) and not is_eof:
+                    break  # the number might be truncated at the end of buf
+                n_frame = int(match.group(1))
+                if n_frame < prev_n_frame:
+                    return False
+                prev_n_frame = n_frame
+                end = match.end()
+            if is_eof:
+                return True
+            # keep the tail which might contain a truncated match
+            buf = buf[max(end, len(buf) - 64) :]
+
+
+_worker_sink = None
+
+
+def _get_worker_sink(shard_pattern, shard_maxcount, registry):
+    # the shard writer is created once and kept until _close_worker_sink
+    global _worker_sink
+    if _worker_sink is None:
+        _worker_sink = DirectShardWriter(shard_pattern, shard_maxcount, registry)
+    return _worker_sink
+
+
+def _close_worker_sink(barrier):
+    # the barrier lets every worker of the pool run this exactly once
+    global _worker_sink
+    barrier.wait()
+    if _worker_sink is not None:
+        _worker_sink.close()
+        _worker_sink = None
+
+
+def _write_window_async(
     n_frame,
     n_frames_que,
     frame_size,
@@ -302,8 +863,11 @@ def _add_write_que_async(
     flow_sna,
     ht_que,
     head,
-    sink,
-    lock,
+    finished_windows,
+    shard_pattern,
+    shard_maxcount,
+    registry,
+    cond,
     pbar,
     video_name,
     dataset_type,
@@ -311,72 +875,74 @@ def _add_write_que_async(
     stride,
     resize,
 ):
-    with lock:
-        # copy queue
-        if frame_sna is not None and flow_sna is not None:
-            frame_que, frame_shm = frame_sna.ndarray()
-            copy_frame_que = copy.deepcopy(frame_que)
-            frame_shm.close()
-            del frame_que
-            flow_que, flow_shm = flow_sna.ndarray()
-            copy_flow_que = copy.deepcopy(flow_que)
-            flow_shm.close()
-            del flow_que
-        else:
-            copy_frame_que = None
-            copy_flow_que = None
-        copy_n_frames_que = copy.deepcopy(list(n_frames_que))
-        copy_ht_que = copy.deepcopy(list(ht_que))
-
-        # update head
-        head_val_copy = int(head.value)
-        head.value = (head.value + stride) % seq_len
-
-    # sort to start from head
-    sorted_idxs = list(range(head_val_copy, seq_len)) + list(range(0, head_val_copy))
-    if copy_frame_que is not None and copy_flow_que is not None:
-        copy_frame_que = copy_frame_que[sorted_idxs].astype(np.uint8)
-        copy_flow_que = copy_flow_que[sorted_idxs].astype(np.float32)
-    copy_n_frames_que = [copy_n_frames_que[idx] for idx in sorted_idxs]
-    copy_ht_que = [copy_ht_que[idx] for idx in sorted_idxs]
+    # slots of the window, which are never overwritten until it is released
+    que_len = len(ht_que)
+    window_idxs = np.arange(n_frame - seq_len, n_frame) % que_len
+    copy_n_frames_que = list(n_frames_que)
+    copy_n_frames_que = [copy_n_frames_que[idx] for idx in window_idxs]
+    copy_ht_que = list(ht_que)
+    copy_ht_que = [copy_ht_que[idx] for idx in window_idxs]
 
     # check data
-    assert (
-        n_frame % seq_len == head_val_copy
-    ), f"n_frame % seq_len:{n_frame % seq_len}, head:{head_val_copy}"
     assert copy_n_frames_que == list(
         range(n_frame - seq_len, n_frame)
     ), f"copy_n_frames_que:{copy_n_frames_que}"
-    assert (
-        n_frame == copy_n_frames_que[-1] + 1
-    ), f"n_frame:{n_frame}, copy_n_frames_que[-1] + 1:{copy_n_frames_que[-1] + 1}"
 
-    # clip frames and flows by bboxs
-    if copy_frame_que is not None and copy_flow_que is not None:
+    # clip frames and flows by bboxs straight from the rings,
+    # only the resized crops are materialised
+    if frame_sna is not None and flow_sna is not None:
+        frame_que, frame_shm = frame_sna.ndarray()
+        flow_que, flow_shm = flow_sna.ndarray()
         idv_frames, idv_flows = clip_images_by_bbox(
-            copy_frame_que, copy_flow_que, copy_ht_que, resize
+            frame_que, flow_que, copy_ht_que, resize, window_idxs
         )
+        del frame_que, flow_que
+        frame_shm.close()
+        flow_shm.close()
     else:
         idv_frames = None
         idv_flows = None
 
+    # release the frames which are no longer referred by this window
+    _release_window(n_frame, head, finished_windows, cond, seq_len, stride)
+
+    sink = _get_worker_sink(shard_pattern, shard_maxcount, registry)
     if len(copy_ht_que) == 0:
         # There are no individuals within frames for seq_len (not error)
+        sink.write_window(n_frame, [])
         pbar.update()
-        del copy_frame_que, copy_flow_que, copy_ht_que
+        del copy_ht_que
         gc.collect()
         return
 
+    samples = _create_window_samples(
+        n_frame,
+        copy_ht_que,
+        idv_frames,
+        idv_flows,
+        frame_size,
+        video_name,
+        dataset_type,
+    )
+    sink.write_window(n_frame, samples)
+
+    pbar.update()
+    del samples, idv_frames, idv_flows, copy_ht_que
+    gc.collect()
+
+
+def _create_window_samples(
+    n_frame, ht_que, idv_frames, idv_flows, frame_size, video_name, dataset_type
+):
     # collect human tracking data
     unique_ids = set(
-        itertools.chain.from_iterable(
-            [[idv["id"] for idv in idvs] for idvs in copy_ht_que]
-        )
+        itertools.chain.from_iterable([[idv["id"] for idv in idvs] for idvs in ht_que])
     )
     unique_ids = sorted(list(unique_ids))
-    meta, ids, bboxs, kps = collect_human_tracking(copy_ht_que, unique_ids)
+    meta, ids, bboxs, kps = collect_human_tracking(ht_que, unique_ids)
     frame_size = (frame_size[1], frame_size[0])  # (h, w)
 
+    samples = []
     if len(meta) > 0:
         if dataset_type == "individual":
             idv_npzs, unique_ids = individual_to_npz(
@@ -384,8 +950,7 @@ def _add_write_que_async(
             )
             for i, _id in enumerate(unique_ids):
                 data = {"__key__": f"{video_name}_{n_frame}_{_id}", "npz": idv_npzs[i]}
-                sink.add_write_que(data)
-                del data
+                samples.append(data)
         elif dataset_type == "group":
             npz = {
                 "meta": meta,
@@ -398,11 +963,8 @@ def _add_write_que_async(
                 npz["frames"] = idv_frames
                 npz["flows"] = idv_flows
             data = {"__key__": f"{video_name}_{n_frame}", "npz": npz}
-            sink.add_write_que(data)
-            del data
+            samples.append(data)
         else:
             raise ValueError
 
-    pbar.update()
-    del copy_frame_que, copy_flow_que, copy_ht_que
-    gc.collect()
+    return samples
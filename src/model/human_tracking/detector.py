@@ -4,9 +4,11 @@ from typing import List, Tuple
 
 import numpy as np
 import torch
+from mmengine.dataset import Compose, pseudo_collate
+from mmengine.registry import init_default_scope
 from mmpose.apis import inference_topdown, init_model
 from mmpose.evaluation.functional import nms
-from mmpose.structures import PoseDataSample
+from mmpose.structures import PoseDataSample, merge_data_samples
 from numpy.typing import NDArray
 from ultralytics import YOLO
 
@@ -28,6 +30,9 @@ class Detector:
         self._yolo = self._yolo.to(device)
 
         self._pose_model = init_model(cfg.pose.config, cfg.pose.weights, device=device)
+        self._pose_pipeline = Compose(
+            self._pose_model.cfg.test_dataloader.dataset.pipeline
+        )
 
     def __del__(self):
         del self._yolo, self._pose_model
@@ -54,6 +59,65 @@ class Detector:
 
         return bboxs, kps
 
+    def predict_batch(self, imgs: List[NDArray]) -> List[Tuple[NDArray, NDArray]]:
+        yolo_results = self._yolo.predict(list(imgs), verbose=False)
+        bboxs_lst = [
+            self._process_yolo_results(result.boxes.data.cpu().numpy())
+            for result in yolo_results
+        ]
+
+        # pose estimation of the persons pooled across all frames
+        pose_results = self._inference_topdown_batch(imgs, bboxs_lst)
+
+        results = []
+        i = 0
+        for bboxs in bboxs_lst:
+            if len(bboxs) > 0:
+                kps = self._collect_kps(pose_results[i : i + len(bboxs)])
+                i += len(bboxs)
+
+                # extract unique result
+                remain_indices = self._del_leaky(kps)
+                remain_indices = self._get_unique(kps, remain_indices)
+                bboxs = bboxs[remain_indices]
+                kps = kps[remain_indices]
+            else:
+                kps = np.empty((0, self._n_kps, 3), np.float32)
+            results.append((bboxs, kps))
+
+        return results
+
+    @property
+    def _n_kps(self):
+        return self._pose_model.dataset_meta["num_keypoints"]
+
+    def _inference_topdown_batch(
+        self, imgs: List[NDArray], bboxs_lst: List[NDArray]
+    ) -> List[PoseDataSample]:
+        # same as inference_topdown, but the bboxs of several images are
+        # processed in batches of cfg.pose.batch_size
+        scope = self._pose_model.cfg.get("default_scope", "mmpose")
+        if scope is not None:
+            init_default_scope(scope)
+
+        data_list = []
+        for img, bboxs in zip(imgs, bboxs_lst):
+            for bbox in bboxs[:, :4]:
+                data_info = dict(img=img)
+                data_info["bbox"] = bbox[None]  # shape (1, 4)
+                data_info["bbox_score"] = np.ones(1, dtype=np.float32)  # shape (1,)
+                data_info.update(self._pose_model.dataset_meta)
+                data_list.append(self._pose_pipeline(data_info))
+
+        results = []
+        batch_size = self._cfg.pose.batch_size
+        for i in range(0, len(data_list), batch_size):
+            batch = pseudo_collate(data_list[i : i + batch_size])
+            with torch.no_grad():
+                results += self._pose_model.test_step(batch)
+
+        return results
+
     def _process_yolo_results(self, bboxs):
         bboxs = bboxs[
             np.logical_and(bboxs[:, 4] > self._cfg.yolo.th_conf, bboxs[:, 5] == 0)
@@ -71,42 +135,43 @@ class Detector:
 
     @staticmethod
     def _collect_kps(det_results: List[PoseDataSample]):
-        return np.array(
+        # stack instances of all results at once
+        pred_instances = merge_data_samples(det_results).pred_instances
+        return np.concatenate(
             [
-                np.hstack(
-                    [
-                        result.pred_instances.keypoints[0],
-                        result.pred_instances.keypoint_scores.T,
-                    ]
-                )
-                for result in det_results
-            ]
+                pred_instances.keypoints,
+                pred_instances.keypoint_scores[:, :, np.newaxis],
+            ],
+            axis=2,
         )
 
     def _del_leaky(self, kps: NDArray):
         return np.where(np.mean(kps[:, :, 2], axis=1) >= self._cfg.pose.th_delete)[0]
 
     def _get_unique(self, kps: NDArray, indices: NDArray):
-        remain_indices = np.empty((0,), dtype=np.int32)
-
-        for idx in indices:
-            for ridx in remain_indices:
-                # calc diff of all points
-                diff = np.linalg.norm(kps[idx, :, :2] - kps[ridx, :, :2], axis=1)
-
-                if (
-                    len(np.where(diff < self._cfg.pose.th_diff)[0])
-                    >= self._cfg.pose.th_count
-                ):
-                    # found overlap
-                    if np.mean(kps[idx, :, 2]) > np.mean(kps[ridx, :, 2]):
-                        # select one which is more confidence
-                        remain_indices[remain_indices == ridx] = idx
-
-                    break
+        pts = kps[indices, :, :2]
+        confs = np.mean(kps[indices, :, 2], axis=1)
+
+        # calc diff of all points between all pairs at once
+        diff = np.linalg.norm(pts[:, np.newaxis] - pts[np.newaxis], axis=3)
+        is_overlap = (
+            np.count_nonzero(diff < self._cfg.pose.th_diff, axis=2)
+            >= self._cfg.pose.th_count
+        )
+
+        # positions of remaining poses in indices
+        remains = []
+        for i in range(len(indices)):
+            is_overlap_remain = is_overlap[i, remains]
+            if np.any(is_overlap_remain):
+                # found overlap with the first one in remains
+                j = np.argmax(is_overlap_remain)
+                if confs[i] > confs[remains[j]]:
+                    # select one which is more confidence
+                    remains[j] = i
             else:
                 # if there aren't overlapped
-                remain_indices = np.append(remain_indices, idx)
+                remains.append(i)
 
         # return unique_kps
-        return remain_indices
+        return indices[np.array(remains, dtype=int)]
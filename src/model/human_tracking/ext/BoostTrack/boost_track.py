@@ -5,125 +5,164 @@
 from __future__ import print_function
 
 from copy import deepcopy
-from typing import List, Optional
+from typing import Optional
 
 import numpy as np
 
 from .assoc import associate, iou_batch
 from .ecc import ECC
-from .kalmanfilter import KalmanFilter
+from .kalmanfilter import KalmanFilterBank
 
 
 def convert_bbox_to_z(bbox):
     """
-    Takes a bounding box in the form [x1,y1,x2,y2] and returns z in the form
-      [x,y,h,r] where x,y is the centre of the box and h is the height and r is
-      the aspect ratio
+    Takes bounding boxes in the form [x1,y1,x2,y2] (n, 4) and returns z in the
+      form [x,y,h,r] (n, 4) where x,y is the centre of the box and h is the
+      height and r is the aspect ratio
     """
-    w = bbox[2] - bbox[0]
-    h = bbox[3] - bbox[1]
-    x = bbox[0] + w / 2.0
-    y = bbox[1] + h / 2.0
+    w = bbox[:, 2] - bbox[:, 0]
+    h = bbox[:, 3] - bbox[:, 1]
+    x = bbox[:, 0] + w / 2.0
+    y = bbox[:, 1] + h / 2.0
 
-    r = w / float(h + 1e-6)
+    r = w / (h + 1e-6)
 
-    return np.array([x, y, h, r]).reshape((4, 1))
+    return np.stack([x, y, h, r], axis=1)
 
 
 def convert_x_to_bbox(x, score=None):
     """
-    Takes a bounding box in the centre form [x,y,h,r] and returns it in the form
-      [x1,y1,x2,y2] where x1,y1 is the top left and x2,y2 is the bottom right
+    Takes bounding boxes in the centre form [x,y,h,r] (n, 4+) and returns them
+      in the form [x1,y1,x2,y2] (n, 4) where x1,y1 is the top left and x2,y2 is
+      the bottom right
     """
 
-    h = x[2]
-    r = x[3]
-    w = 0 if r <= 0 else r * h
+    h = x[:, 2]
+    r = x[:, 3]
+    w = np.where(r <= 0, 0, r * h)
 
-    if score is None:
-        return np.array(
-            [x[0] - w / 2.0, x[1] - h / 2.0, x[0] + w / 2.0, x[1] + h / 2.0]
-        ).reshape((1, 4))
-    else:
-        return np.array(
-            [x[0] - w / 2.0, x[1] - h / 2.0, x[0] + w / 2.0, x[1] + h / 2.0, score]
-        ).reshape((1, 5))
+    bbox = [x[:, 0] - w / 2.0, x[:, 1] - h / 2.0, x[:, 0] + w / 2.0, x[:, 1] + h / 2.0]
+    if score is not None:
+        bbox.append(score)
+    return np.stack(bbox, axis=1)
 
 
-class KalmanBoxTracker(object):
+class KalmanBoxTrackerBank(object):
     """
-    This class represents the internal state of individual tracked objects observed as bbox.
+    This class represents the internal states of all tracked objects observed as
+    bbox. The states of n tracklets are stacked at the first axis of each array.
     """
 
     count = 0
 
-    def __init__(self, bbox, emb: Optional[np.ndarray] = None):
-        """
-        Initialises a tracker using initial bounding box.
-
-        """
-
+    def __init__(self):
         self.bbox_to_z_func = convert_bbox_to_z
         self.x_to_bbox_func = convert_x_to_bbox
 
-        self.time_since_update = 0
-        self.id = KalmanBoxTracker.count
-        KalmanBoxTracker.count += 1
+        self.kf = KalmanFilterBank()
+        self.ids = np.zeros((0,), dtype=int)
+        self.time_since_update = np.zeros((0,), dtype=int)
+        self.hit_streak = np.zeros((0,), dtype=int)
+        self.age = np.zeros((0,), dtype=int)
+        self.embs = None
+        # index of the detection matched at the last update
+        self.det_idxs = np.zeros((0,), dtype=int)
 
-        self.kf = KalmanFilter(self.bbox_to_z_func(bbox))
-        self.emb = emb
-        self.hit_streak = 0
-        self.age = 0
+    def __len__(self):
+        return len(self.ids)
 
-    def get_confidence(self, coef: float = 0.9) -> float:
+    def add(self, bboxes: np.ndarray, embs: np.ndarray, det_idxs: np.ndarray):
+        """
+        Initialises trackers using initial bounding boxes.
+        """
+        n = len(bboxes)
+        ids = np.arange(KalmanBoxTrackerBank.count, KalmanBoxTrackerBank.count + n)
+        KalmanBoxTrackerBank.count += n
+
+        self.kf.append(self.bbox_to_z_func(bboxes))
+        self.ids = np.concatenate([self.ids, ids])
+        self.time_since_update = np.concatenate(
+            [self.time_since_update, np.zeros(n, dtype=int)]
+        )
+        self.hit_streak = np.concatenate([self.hit_streak, np.zeros(n, dtype=int)])
+        self.age = np.concatenate([self.age, np.zeros(n, dtype=int)])
+        if self.embs is None:
+            self.embs = np.zeros((0, embs.shape[1]))
+        self.embs = np.concatenate([self.embs, embs])
+        self.det_idxs = np.concatenate([self.det_idxs, det_idxs])
+
+    def remove(self, mask: np.ndarray):
+        if len(self) == 0:
+            # embs is not allocated until the first tracklet is added
+            return
+
+        self.kf.delete(mask)
+        self.ids = self.ids[~mask]
+        self.time_since_update = self.time_since_update[~mask]
+        self.hit_streak = self.hit_streak[~mask]
+        self.age = self.age[~mask]
+        self.embs = self.embs[~mask]
+        self.det_idxs = self.det_idxs[~mask]
+
+    def get_confidence(self, coef: float = 0.9) -> np.ndarray:
         n = 7
 
-        if self.age < n:
-            return coef ** (n - self.age)
-        return coef ** (self.time_since_update - 1)
+        return np.where(
+            self.age < n,
+            coef ** (n - self.age),
+            coef ** (self.time_since_update - 1.0),
+        )
 
-    def update(self, bbox: np.ndarray, score: float = 0):
+    def update(
+        self,
+        idxs: np.ndarray,
+        bboxes: np.ndarray,
+        scores: np.ndarray,
+        det_idxs: np.ndarray,
+    ):
         """
-        Updates the state vector with observed bbox.
+        Updates the state vectors of the given trackers with observed bboxes.
         """
 
-        self.time_since_update = 0
-        self.hit_streak += 1
-        self.kf.update(self.bbox_to_z_func(bbox), score)
+        self.det_idxs[idxs] = det_idxs
+        self.time_since_update[idxs] = 0
+        self.hit_streak[idxs] += 1
+        self.kf.update(idxs, self.bbox_to_z_func(bboxes))
 
     def camera_update(self, transform: np.ndarray):
-        x1, y1, x2, y2 = self.get_state()[0]
-        x1_, y1_, _ = transform @ np.array([x1, y1, 1]).T
-        x2_, y2_, _ = transform @ np.array([x2, y2, 1]).T
-        w, h = x2_ - x1_, y2_ - y1_
-        cx, cy = x1_ + w / 2, y1_ + h / 2
-        self.kf.x[:4] = [cx, cy, h, w / h]
+        bboxes = self.get_state()
+        ones = np.ones((len(bboxes), 1))
+        pt1 = np.hstack([bboxes[:, :2], ones]) @ transform.T
+        pt2 = np.hstack([bboxes[:, 2:], ones]) @ transform.T
+        w, h = pt2[:, 0] - pt1[:, 0], pt2[:, 1] - pt1[:, 1]
+        cx, cy = pt1[:, 0] + w / 2, pt1[:, 1] + h / 2
+        self.kf.x[:, :4] = np.stack([cx, cy, h, w / h], axis=1)
 
     def predict(self):
         """
-        Advances the state vector and returns the predicted bounding box estimate.
+        Advances the state vectors and returns the predicted bounding box estimates.
         """
 
         self.kf.predict()
         self.age += 1
-        if self.time_since_update > 0:
-            self.hit_streak = 0
+        self.hit_streak[self.time_since_update > 0] = 0
         self.time_since_update += 1
 
         return self.x_to_bbox_func(self.kf.x)
 
     def get_state(self):
         """
-        Returns the current bounding box estimate.
+        Returns the current bounding box estimates.
         """
         return self.x_to_bbox_func(self.kf.x)
 
-    def update_emb(self, emb, alpha=0.9):
-        self.emb = alpha * self.emb + (1 - alpha) * emb
-        self.emb /= np.linalg.norm(self.emb)
+    def update_emb(self, idxs, embs, alpha=0.9):
+        alpha = alpha.reshape(-1, 1)
+        embs = alpha * self.embs[idxs] + (1 - alpha) * embs
+        self.embs[idxs] = embs / np.linalg.norm(embs, axis=1, keepdims=True)
 
     def get_emb(self):
-        return self.emb
+        return self.embs
 
 
 class BoostTrack(object):
@@ -145,7 +184,7 @@ class BoostTrack(object):
 
         self.max_age = max_age
         self.iou_threshold = iou_threshold
-        self.trackers: List[KalmanBoxTracker] = []
+        self.trackers = KalmanBoxTrackerBank()
         self.frame_count = 0
         self.det_thresh = det_thresh
         self.min_hits = min_hits
@@ -163,9 +202,17 @@ class BoostTrack(object):
         else:
             self.ecc = None
 
+    def reset(self):
+        self.trackers = KalmanBoxTrackerBank()
+        self.frame_count = 0
+
     def update(self, dets, img_tensor, img_numpy, tag):
+        """
+        Returns tracks (n, 7) of [x1, y1, x2, y2, id + 1, confidence, det_idx]
+          where det_idx is the index of the matched detection in dets
+        """
         if dets is None:
-            return np.empty((0, 5))
+            return np.empty((0, 7))
         if not isinstance(dets, np.ndarray):
             dets = dets.cpu().detach().numpy()
 
@@ -182,17 +229,12 @@ class BoostTrack(object):
 
         if self.use_ecc:
             transform = self.ecc(img_numpy, self.frame_count, tag)
-            for trk in self.trackers:
-                trk.camera_update(transform)
+            self.trackers.camera_update(transform)
 
         # get predicted locations from existing trackers.
-        trks = np.zeros((len(self.trackers), 5))
-        confs = np.zeros((len(self.trackers), 1))
-
-        for t in range(len(trks)):
-            pos = self.trackers[t].predict()[0]
-            confs[t] = self.trackers[t].get_confidence()
-            trks[t] = [pos[0], pos[1], pos[2], pos[3], confs[t, 0]]
+        pos = self.trackers.predict()
+        confs = self.trackers.get_confidence().reshape(-1, 1)
+        trks = np.hstack([pos, confs])
 
         if self.use_dlo_boost:
             dets = self.do_iou_confidence_boost(dets)
@@ -202,6 +244,7 @@ class BoostTrack(object):
 
         remain_inds = dets[:, 4] >= self.det_thresh
         dets = dets[remain_inds]
+        det_idxs = np.nonzero(remain_inds)[0]
         scores = dets[:, 4]
 
         if mahalanobis_distance is not None and mahalanobis_distance.size > 0:
@@ -230,68 +273,57 @@ class BoostTrack(object):
         af = 0.95
         dets_alpha = af + (1 - af) * (1 - trust)
 
-        for m in matched:
-            self.trackers[m[1]].update(dets[m[0], :], scores[m[0]])
-            self.trackers[m[1]].update_emb(dets_embs[m[0]], alpha=dets_alpha[m[0]])
-
-        for i in unmatched_dets:
-            if dets[i, 4] >= self.det_thresh:
-                self.trackers.append(KalmanBoxTracker(dets[i, :], emb=dets_embs[i]))
-
-        ret = []
-        i = len(self.trackers)
-        for trk in reversed(self.trackers):
-            d = trk.get_state()[0]
-            if (trk.time_since_update < 1) and (
-                trk.hit_streak >= self.min_hits or self.frame_count <= self.min_hits
-            ):
-                # +1 as MOT benchmark requires positive
-                ret.append(
-                    np.concatenate((d, [trk.id + 1], [trk.get_confidence()])).reshape(
-                        1, -1
-                    )
-                )
-            i -= 1
-            # remove dead tracklet
-            if trk.time_since_update > self.max_age:
-                self.trackers.pop(i)
+        if len(matched) > 0:
+            idxs_det, idxs_trk = matched[:, 0], matched[:, 1]
+            self.trackers.update(
+                idxs_trk, dets[idxs_det, :], scores[idxs_det], det_idxs[idxs_det]
+            )
+            self.trackers.update_emb(
+                idxs_trk, dets_embs[idxs_det], alpha=dets_alpha[idxs_det]
+            )
 
-        if len(ret) > 0:
-            return np.concatenate(ret)
-        return np.empty((0, 5))
+        unmatched_dets = unmatched_dets.astype(int)
+        unmatched_dets = unmatched_dets[dets[unmatched_dets, 4] >= self.det_thresh]
+        if len(unmatched_dets) > 0:
+            self.trackers.add(
+                dets[unmatched_dets, :],
+                dets_embs[unmatched_dets],
+                det_idxs[unmatched_dets],
+            )
+
+        is_output = (self.trackers.time_since_update < 1) & (
+            (self.trackers.hit_streak >= self.min_hits)
+            | (self.frame_count <= self.min_hits)
+        )
+        # in reverse order of trackers
+        idxs = np.nonzero(is_output)[0][::-1]
+        # +1 as MOT benchmark requires positive
+        ret = np.hstack(
+            [
+                self.trackers.get_state()[idxs],
+                self.trackers.ids[idxs].reshape(-1, 1) + 1,
+                self.trackers.get_confidence()[idxs].reshape(-1, 1),
+                self.trackers.det_idxs[idxs].reshape(-1, 1),
+            ]
+        )
+
+        # remove dead tracklet
+        self.trackers.remove(self.trackers.time_since_update > self.max_age)
+
+        return ret
 
     def dump_cache(self):
         if self.use_ecc:
             self.ecc.save_cache()
 
     def get_iou_matrix(self, detections: np.ndarray) -> np.ndarray:
-        trackers = np.zeros((len(self.trackers), 5))
-        for t, trk in enumerate(trackers):
-            pos = self.trackers[t].get_state()[0]
-            trk[:] = [pos[0], pos[1], pos[2], pos[3], 0]
-        return iou_batch(detections, trackers)
+        return iou_batch(detections, self.trackers.get_state())
 
     def get_mh_dist_matrix(self, detections: np.ndarray, n_dims: int = 4) -> np.ndarray:
         if len(self.trackers) == 0:
             return np.zeros((0, 0))
-        z = np.zeros((len(detections), n_dims), dtype=float)
-        x = np.zeros((len(self.trackers), n_dims), dtype=float)
-        sigma_inv = np.zeros_like(x, dtype=float)
-
-        f = self.trackers[0].bbox_to_z_func
-        for i in range(len(detections)):
-            z[i, :n_dims] = f(detections[i, :]).reshape((-1,))[:n_dims]
-        for i in range(len(self.trackers)):
-            x[i] = self.trackers[i].kf.x[:n_dims]
-            # Note: we assume diagonal covariance matrix
-            sigma_inv[i] = np.reciprocal(
-                np.diag(self.trackers[i].kf.covariance[:n_dims, :n_dims])
-            )
-
-        return (
-            (z.reshape((-1, 1, n_dims)) - x.reshape((1, -1, n_dims))) ** 2
-            * sigma_inv.reshape((1, -1, n_dims))
-        ).sum(axis=2)
+        z = self.trackers.bbox_to_z_func(detections)
+        return self.trackers.kf.mahalanobis_distance(z, n_dims)
 
     def do_mh_dist_confidence_boost(self, detections: np.ndarray) -> np.ndarray:
         n_dims = 4
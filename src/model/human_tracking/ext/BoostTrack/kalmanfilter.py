@@ -197,3 +197,133 @@ class KalmanFilter(object):
         )
 
         return self.x, self.covariance
+
+
+class KalmanFilterBank(object):
+    """
+    Kalman filters of all tracklets stored as a structure of arrays.
+
+    The state space and the model matrices are the same as KalmanFilter. The
+    means x (n, 8) and the covariances (n, 8, 8) of n filters are stacked at
+    the first axis, so that each step runs for all filters at once.
+
+    """
+
+    def __init__(
+        self,
+        ndim: int = 8,
+        dt: int = 1,
+        cov_update_policy: CovariancePolicy = ConstantNoise,
+    ):
+        self.dt = dt
+        self.ndim = ndim
+        self.cov_update_policy: CovariancePolicy = cov_update_policy(ndim, 4)
+        # Create Kalman filter model matrices.
+        self._motion_mat = np.eye(ndim, ndim)
+        for i in range(4 - (ndim % 2)):
+            self._motion_mat[i, i + 4] = dt
+
+        self._update_mat = np.eye(4, ndim)
+
+        self.x = np.zeros((0, ndim))
+        self.covariance = np.zeros((0, ndim, ndim))
+
+    def __len__(self):
+        return len(self.x)
+
+    def append(self, z: np.ndarray):
+        """Add new filters initialised by measurements z (n, 4)."""
+        x = np.zeros((len(z), self.ndim))
+        x[:, :4] = z
+        covariance = np.broadcast_to(
+            self.cov_update_policy.get_init_state_cov(z),
+            (len(z), self.ndim, self.ndim),
+        )
+
+        self.x = np.concatenate([self.x, x])
+        self.covariance = np.concatenate([self.covariance, covariance])
+
+    def delete(self, idxs: np.ndarray):
+        """Remove filters of the given indices or boolean mask."""
+        self.x = np.delete(self.x, idxs, axis=0)
+        self.covariance = np.delete(self.covariance, idxs, axis=0)
+
+    def predict(self):
+        """Run Kalman filter prediction step of all filters.
+
+        Returns
+        -------
+        (ndarray, ndarray)
+            Returns the mean vectors (n, 8) and covariance matrices (n, 8, 8)
+            of the predicted states.
+
+        """
+        motion_cov = self.cov_update_policy.get_Q(self.x)
+
+        self.x = self.x @ self._motion_mat.T
+        self.covariance = (
+            self._motion_mat @ self.covariance @ self._motion_mat.T + motion_cov
+        )
+
+        return self.x, self.covariance
+
+    def project(self, idxs: Optional[np.ndarray] = None):
+        """Project state distributions to measurement space.
+
+        Returns
+        -------
+        (ndarray, ndarray)
+            Returns the projected means (n, 4) and covariance matrices
+            (n, 4, 4) of the given filters, all filters if idxs is None.
+
+        """
+        if idxs is None:
+            idxs = slice(None)
+        x = self.x[idxs]
+        innovation_cov = self.cov_update_policy.get_R(x, 0)
+
+        mean = x @ self._update_mat.T
+        covariance = self._update_mat @ self.covariance[idxs] @ self._update_mat.T
+        return mean, covariance + innovation_cov
+
+    def update(self, idxs: np.ndarray, z: np.ndarray):
+        """Run Kalman filter correction step of the given filters.
+
+        Parameters
+        ----------
+        idxs : ndarray
+            Indices (m,) of the filters to be corrected, without duplicates.
+        z : ndarray
+            Measurements (m, 4) of the filters.
+
+        """
+        x = self.x[idxs]
+        covariance = self.covariance[idxs]
+        projected_mean, projected_cov = self.project(idxs)
+
+        # K = P H^T S^-1, S is symmetric
+        kalman_gain = np.linalg.solve(
+            projected_cov, (covariance @ self._update_mat.T).transpose(0, 2, 1)
+        ).transpose(0, 2, 1)
+
+        innovation = z - projected_mean
+
+        self.x[idxs] = x + (kalman_gain @ innovation[:, :, None])[:, :, 0]
+        self.covariance[idxs] = covariance - (
+            kalman_gain @ projected_cov @ kalman_gain.transpose(0, 2, 1)
+        )
+
+    def mahalanobis_distance(self, z: np.ndarray, n_dims: int = 4) -> np.ndarray:
+        """Squared Mahalanobis distances (m, n) between measurements z (m, 4)
+        and the states of all filters.
+
+        Note: the covariance matrices are assumed to be diagonal.
+        """
+        x = self.x[:, :n_dims]
+        sigma_inv = np.reciprocal(
+            np.diagonal(self.covariance, axis1=1, axis2=2)[:, :n_dims]
+        )
+
+        return (
+            (z[:, None, :n_dims] - x[None, :, :]) ** 2 * sigma_inv[None, :, :]
+        ).sum(axis=2)
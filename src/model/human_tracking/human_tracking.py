@@ -1,8 +1,7 @@
 from types import SimpleNamespace
+from typing import List
 
 import numpy as np
-import scipy
-import scipy.stats
 import torch
 from numpy.typing import NDArray
 
@@ -23,22 +22,40 @@ class HumanTracking:
     def reset_tracker(self):
         self._tracker.reset()
 
+    @property
+    def config(self) -> SimpleNamespace:
+        return self._cfg
+
+    @property
+    def batch_size(self) -> int:
+        return self._cfg.batch_size
+
     def predict(self, frame: NDArray, frame_num: int):
         # keypoints detection
         bboxs, kps = self._detector.predict(frame)
 
         # tracking
+        return self._track(frame, frame_num, bboxs, kps)
+
+    def predict_batch(self, frames: List[NDArray], frame_nums: List[int]):
+        # keypoints detection of all frames at once
+        detections = self._detector.predict_batch(frames)
+
+        # tracking frame by frame
+        return [
+            self._track(frame, frame_num, bboxs, kps)
+            for frame, frame_num, (bboxs, kps) in zip(frames, frame_nums, detections)
+        ]
+
+    def _track(self, frame: NDArray, frame_num: int, bboxs: NDArray, kps: NDArray):
         tracks = self._tracker.update(bboxs, frame)
         tracks = tracks[np.argsort(tracks[:, 4])]  # sort by track id
 
         # append result
         results = []
         for t in tracks:
-            # get id is closed kps
-            near_idxs = np.where(np.isclose(t[:4], bboxs[:, :4], atol=10.0))[0]
-            if len(near_idxs) < 2:
-                continue
-            i = scipy.stats.mode(near_idxs).mode
+            # index of the detection matched by the tracker
+            i = int(t[6])
 
             # create result
             result = {
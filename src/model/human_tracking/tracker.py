@@ -17,7 +17,7 @@ class Tracker:
         torch.cuda.empty_cache()
 
     def reset(self):
-        self.tracker.trackers = []
+        self.tracker.reset()
 
     def update(self, bboxs: NDArray, img: NDArray):
         img_tensor = np.array([img]).transpose(0, 3, 1, 2)
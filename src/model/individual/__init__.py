@@ -1,2 +1,3 @@
 from .vae import VAE
 from .sqvae import SQVAE
+from .results import unbatch_results
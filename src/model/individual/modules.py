@@ -6,7 +6,14 @@ import torch.nn as nn
 import torch.nn.functional as F
 from rotary_embedding_torch import RotaryEmbedding
 
-from src.model.layers import MLP, TransformerDecoderBlock, TransformerEncoderBlock
+from src.model.layers import (
+    MLP,
+    GroupedMLP,
+    GroupedRotaryEmbedding,
+    GroupedTransformerDecoderBlock,
+    TransformerEncoderBlock,
+    stack_grouped_state_dict,
+)
 
 
 def get_n_pts(config: SimpleNamespace):
@@ -186,10 +193,11 @@ class GaussianVectorQuantizer(nn.Module):
         )
 
     def calc_distance(self, z, book):
+        # z (..., n, latent_ndim), book (..., book_size, latent_ndim)
         distances = (
-            torch.sum(z**2, dim=1, keepdim=True)
-            + torch.sum(book**2, dim=1)
-            - 2 * torch.matmul(z, book.t())
+            torch.sum(z**2, dim=-1, keepdim=True)
+            + torch.sum(book**2, dim=-1).unsqueeze(-2)
+            - 2 * torch.matmul(z, book.transpose(-1, -2))
         )
         return distances
 
@@ -206,48 +214,24 @@ class GaussianVectorQuantizer(nn.Module):
         param_q = 1 + self.log_param_q.exp()
         precision_q = 0.5 / torch.clamp(param_q, min=1e-10)
 
+        # books (n_clusters, book_size, latent_ndim)
+        books = torch.stack(list(self.books.parameters()), dim=0)
+
         if is_train:
             param_q = 1 + self.log_param_q_cls.exp()
             precision_q_cls = 0.5 / torch.clamp(param_q, min=1e-10)
-
-            logits = torch.empty((0, n_pts, self.book_size)).to(ze.device)
-            zq = torch.empty((0, n_pts, latent_ndim)).to(ze.device)
-            for i, c_logit in enumerate(c_logits):
-                c_prob = self.gumbel_softmax_relaxation(c_logit * precision_q_cls)
-
-                # compute logits and zq of all books
-                zei = ze[i]
-                zqi = torch.zeros_like(zei)
-                logit = torch.zeros((n_pts, self.book_size)).to(ze.device)
-                books = torch.cat(list(self.books.parameters()), dim=0)
-                books = books.view(-1, self.book_size, latent_ndim)
-                for j, book in enumerate(books):
-                    logitj = -self.calc_distance(zei, book) * precision_q
-                    logit = logit + logitj * c_prob[j]
-                    encoding = self.gumbel_softmax_relaxation(logitj)
-                    zqi = zqi + torch.matmul(encoding, book) * c_prob[j]
-
-                logits = torch.cat(
-                    [logits, logit.view(1, n_pts, self.book_size)], dim=0
-                )
-                books = torch.cat(
-                    [books, book.view(1, self.book_size, latent_ndim)], dim=0
-                )
-                zq = torch.cat([zq, zqi.view(1, n_pts, latent_ndim)], dim=0)
-                # mean_prob = torch.mean(prob.detach(), dim=0)
+            c_prob = self.gumbel_softmax_relaxation(c_logits * precision_q_cls)
+
+            # compute logits and zq of all books at once
+            # logits_all (b, n_clusters, n_pts, book_size)
+            logits_all = -self.calc_distance(ze.unsqueeze(1), books) * precision_q
+            logits = torch.einsum("bcnk,bc->bnk", logits_all, c_prob)
+            encodings = self.gumbel_softmax_relaxation(logits_all)
+            zq = torch.einsum("bcnk,ckd,bc->bnd", encodings, books, c_prob)
+            # mean_prob = torch.mean(prob.detach(), dim=0)
         else:
-            logits = torch.empty((0, n_pts, self.book_size)).to(ze.device)
-            books = torch.empty((0, self.book_size, latent_ndim)).to(ze.device)
-            for i, idx in enumerate(c_logits.argmax(dim=-1)):
-                book = self.books[idx]
-                logit = -self.calc_distance(ze[i], book) * precision_q
-
-                logits = torch.cat(
-                    [logits, logit.view(1, n_pts, self.book_size)], dim=0
-                )
-                books = torch.cat(
-                    [books, book.view(1, self.book_size, latent_ndim)], dim=0
-                )
+            books = books[c_logits.argmax(dim=-1)]  # (b, book_size, latent_ndim)
+            logits = -self.calc_distance(ze, books) * precision_q
 
             indices = torch.argmax(logits, dim=2).unsqueeze(2)
             encodings = torch.zeros(
@@ -275,86 +259,71 @@ class Decoder(nn.Module):
     def __init__(self, config: SimpleNamespace):
         super().__init__()
         self.n_pts = get_n_pts(config)
-        self.decoders = nn.ModuleList(
-            [DecoderModule(config) for _ in range(self.n_pts * 2)]
-        )
+        # decoders of all points are computed at once
+        self.decoders = DecoderModule(config, self.n_pts * 2)
 
     def forward(self, kps, bbox, zq):
         b, seq_len = kps.size()[:2]
         kps = kps.view(b, seq_len, -1)
-        recon_kps = torch.empty((b, seq_len, 0)).to(kps.device)
-        for i, decoder in enumerate(self.decoders[: (self.n_pts - 2) * 2]):
-            recon_x = decoder(kps[:, :, i], zq[:, i, :])
-            recon_kps = torch.cat([recon_kps, recon_x], dim=2)
-        recon_kps = recon_kps.view(b, seq_len, (self.n_pts - 2), 2)
-
         bbox = bbox.view(b, seq_len, -1)
-        recon_bbox = torch.empty((b, seq_len, 0)).to(bbox.device)
-        for i, decoder in enumerate(self.decoders[(self.n_pts - 2) * 2 :]):
-            recon_x = decoder(bbox[:, :, i], zq[:, (self.n_pts - 2) * 2 + i, :])
-            recon_bbox = torch.cat([recon_bbox, recon_x], dim=2)
-        recon_bbox = recon_bbox.view(b, seq_len, 2, 2)
+        x = torch.cat([kps, bbox], dim=2)
+        recon_x = self.decoders(x, zq)
+
+        n_kps = (self.n_pts - 2) * 2
+        recon_kps = recon_x[:, :, :n_kps].reshape(b, seq_len, (self.n_pts - 2), 2)
+        recon_bbox = recon_x[:, :, n_kps:].reshape(b, seq_len, 2, 2)
 
         return recon_kps, recon_bbox
 
 
 class DecoderModule(nn.Module):
-    def __init__(self, config: SimpleNamespace):
+    def __init__(self, config: SimpleNamespace, n_groups: int):
         super().__init__()
+        self.n_groups = n_groups
         self.latent_ndim = config.latent_ndim
 
         self.x_start = nn.Parameter(
-            torch.randn((1, 1, config.latent_ndim), dtype=torch.float32),
+            torch.randn((n_groups, 1, 1, config.latent_ndim), dtype=torch.float32),
             requires_grad=True,
         )
 
-        self.emb = MLP(1, config.latent_ndim)
-        self.pe = RotaryEmbedding(config.latent_ndim, learned_freq=True)
-        # self.mlp_z = MLP(config.latent_ndim, config.latent_ndim * config.seq_len)
+        self.emb = GroupedMLP(n_groups, 1, config.latent_ndim)
+        self.pe = GroupedRotaryEmbedding(n_groups, config.latent_ndim)
         self.decoders = nn.ModuleList(
             [
-                TransformerDecoderBlock(
-                    config.latent_ndim, config.nheads, config.dropout
+                GroupedTransformerDecoderBlock(
+                    n_groups, config.latent_ndim, config.nheads, config.dropout
                 )
                 for _ in range(config.nlayers)
             ]
         )
-        # self.mlp = nn.Sequential(
-        #     MLP(config.latent_ndim, config.latent_ndim // 2),
-        #     nn.GroupNorm(1, config.seq_len),
-        #     nn.SiLU(),
-        #     MLP(config.latent_ndim // 2, config.latent_ndim // 4),
-        #     nn.GroupNorm(1, config.seq_len),
-        #     nn.SiLU(),
-        #     MLP(config.latent_ndim // 4, 1),
-        #     nn.Tanh(),
-        # )
         self.mlp = nn.Sequential(
-            MLP(config.latent_ndim, 1),
+            GroupedMLP(n_groups, config.latent_ndim, 1),
             nn.Tanh(),
         )
 
+        # load checkpoints of nn.ModuleList of the previous DecoderModule
+        self.register_load_state_dict_pre_hook(stack_grouped_state_dict)
+
     def forward(self, x, zq, mask=None):
-        # x (b, seq_len)
-        # zq (b, latent_ndim)
+        # x (b, seq_len, n_groups)
+        # zq (b, n_groups, latent_ndim)
 
-        b, seq_len = x.size()
-        x = x.view(b, seq_len, 1)
-        x = self.emb(x)  # (b, seq_len, latent_ndim)
+        b, seq_len = x.size()[:2]
+        x = x.permute(2, 0, 1).reshape(self.n_groups, b, seq_len, 1)
+        x = self.emb(x)  # (n_groups, b, seq_len, latent_ndim)
 
         # concat start token
-        x = torch.cat([self.x_start.repeat((b, 1, 1)), x], dim=1)
-        x = x[:, :-1]  # (b, seq_len, latent_ndim)
+        x = torch.cat([self.x_start.expand(-1, b, -1, -1), x], dim=2)
+        x = x[:, :, :-1]  # (n_groups, b, seq_len, latent_ndim)
 
-        x = self.pe.rotate_queries_or_keys(x, seq_dim=1)
+        x = self.pe.rotate_queries_or_keys(x)
 
-        # zq = self.mlp_z(zq)
-        # zq = zq.view(b, seq_len, self.latent_ndim)
-        zq = zq.unsqueeze(1).repeat(1, seq_len, 1)
+        zq = zq.permute(1, 0, 2).unsqueeze(2).expand(-1, -1, seq_len, -1)
         for layer in self.decoders:
             x = layer(x, zq, mask)
-        # x (b, seq_len, latent_ndim)
+        # x (n_groups, b, seq_len, latent_ndim)
 
-        recon_x = self.mlp(x).view(b, seq_len, 1)
+        recon_x = self.mlp(x).view(self.n_groups, b, seq_len)
 
-        return recon_x
+        return recon_x.permute(1, 2, 0)  # (b, seq_len, n_groups)
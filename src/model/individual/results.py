@@ -0,0 +1,27 @@
+import numpy as np
+import torch
+
+
+def batch_to_numpy(**outputs) -> dict:
+    # copy all outputs of a batch to host asynchronously and synchronize once
+    # outputs: tensors or arrays, the first axis of each is sample
+    is_cuda = False
+    results = {}
+    for name, vals in outputs.items():
+        if isinstance(vals, torch.Tensor):
+            is_cuda = is_cuda or vals.is_cuda
+            vals = vals.detach().to("cpu", non_blocking=True)
+        results[name] = vals
+    if is_cuda:
+        torch.cuda.synchronize()
+
+    return {
+        name: vals.numpy() if isinstance(vals, torch.Tensor) else np.asarray(vals)
+        for name, vals in results.items()
+    }
+
+
+def unbatch_results(results: dict) -> list:
+    # lightweight per-sample views of a batch result
+    n_samples = len(results["key"])
+    return [{name: vals[i] for name, vals in results.items()} for i in range(n_samples)]
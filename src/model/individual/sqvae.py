@@ -13,6 +13,7 @@ from src.model.individual.modules import (
     Encoder,
     GaussianVectorQuantizer,
 )
+from src.model.individual.results import batch_to_numpy
 
 
 class SQVAE(LightningModule):
@@ -212,25 +213,44 @@ class SQVAE(LightningModule):
         mse_kps = self.mse_x(kps, recon_kps)
         mse_bbox = self.mse_x(bbox, recon_bbox)
 
-        results = []
-        for i in range(len(keys)):
-            data = {
-                "key": keys[i],
-                "id": ids[i].cpu().numpy().item(),
-                "kps": kps[i].cpu().numpy(),
-                "recon_kps": recon_kps[i].cpu().numpy(),
-                "mse_kps": mse_kps[i].item(),
-                "bbox": bbox[i].cpu().numpy(),
-                "recon_bbox": recon_bbox[i].cpu().numpy(),
-                "mse_bbox": mse_bbox[i].item(),
-                "ze": ze[i].cpu().numpy(),
-                "zq": zq[i].cpu().numpy(),
-                "attn_w": attn_w[i].cpu().numpy(),
-                "book_prob": prob[i].cpu().numpy(),
-                "book_idx": prob[i].cpu().numpy().argmax(axis=1),
-                "label_prob": c_prob[i].cpu().numpy(),
-                "label": c_prob[i].cpu().numpy().argmax(),
-            }
-            results.append(data)
+        results = batch_to_numpy(
+            key=keys,
+            id=ids.view(-1),
+            kps=kps,
+            recon_kps=recon_kps,
+            mse_kps=mse_kps,
+            bbox=bbox,
+            recon_bbox=recon_bbox,
+            mse_bbox=mse_bbox,
+            ze=ze,
+            zq=zq,
+            attn_w=attn_w,
+            book_prob=prob,
+            book_idx=prob.argmax(dim=-1),
+            label_prob=c_prob,
+            label=c_prob.argmax(dim=-1),
+        )
 
         return results
+
+    @torch.no_grad()
+    def predict_labels(self, batch, return_book_idx=False):
+        # classification only, the quantizer and the decoder are skipped
+        keys, ids, kps, bbox, mask = self.process_batch(batch)
+
+        # attention weights are not collected with is_train=True
+        ze, _ = self.encoder(kps, bbox, True)
+        c_logits, _ = self.cls_head(ze, True)
+        c_prob = F.softmax(c_logits, dim=-1)
+
+        outputs = dict(
+            key=keys,
+            id=ids.view(-1),
+            label_prob=c_prob,
+            label=c_prob.argmax(dim=-1),
+        )
+        if return_book_idx:
+            _, _, prob, _ = self.quantizer(ze, c_logits, False)
+            outputs["book_idx"] = prob.argmax(dim=-1)
+
+        return batch_to_numpy(**outputs)
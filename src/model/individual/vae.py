@@ -8,11 +8,15 @@ import torch.nn.functional as F
 from lightning.pytorch import LightningModule
 from rotary_embedding_torch import RotaryEmbedding
 
+from src.model.individual.results import batch_to_numpy
 from src.model.layers import (
     MLP,
     Embedding,
-    TransformerDecoderBlock,
+    GroupedMLP,
+    GroupedRotaryEmbedding,
+    GroupedTransformerDecoderBlock,
     TransformerEncoderBlock,
+    stack_grouped_state_dict,
 )
 
 # from sklearn.cluster import KMeans
@@ -58,7 +62,8 @@ class VAE(LightningModule):
         # vis_npatchs = self.Qy_x.emb.emb.npatchs
         self.Py = Py(self.config)
         self.Pz_y = Pz_y(self.config)
-        self.Px_z = nn.ModuleList([Px_z(self.config) for _ in range((17 + 2) * 2)])
+        # decoders of all points are computed at once
+        self.Px_z = Px_z(self.config, (17 + 2) * 2)
 
         if self.annotation_path is not None:
             anns = np.loadtxt(self.annotation_path, int, delimiter=" ", skiprows=1)
@@ -116,16 +121,8 @@ class VAE(LightningModule):
 
         b, seq_len = x_kps.size()[:2]
         x_kps = x_kps.view(b, seq_len, 17 * 2)
-        recon_x_kps = torch.empty((b, seq_len, 0)).to(self.device)
-        for i, decoder in enumerate(self.Px_z[: 17 * 2]):
-            recon_x = decoder(x_kps[:, :, i], z[:, i, :])
-            recon_x_kps = torch.cat([recon_x_kps, recon_x], dim=2)
-
         x_bbox = x_bbox.view(b, seq_len, 2 * 2)
-        recon_x_bbox = torch.empty((b, seq_len, 0)).to(self.device)
-        for i, decoder in enumerate(self.Px_z[17 * 2 :]):
-            recon_x = decoder(x_bbox[:, :, i], z[:, i, :])
-            recon_x_bbox = torch.cat([recon_x_bbox, recon_x], dim=2)
+        recon_x_kps, recon_x_bbox = self.decode(x_kps, x_bbox, z)
 
         x_kps = x_kps.view(b, seq_len, 17, 2)
         x_bbox = x_bbox.view(b, seq_len, 2, 2)
@@ -302,6 +299,7 @@ class VAE(LightningModule):
     @torch.no_grad()
     def predict_step(self, batch):
         keys, ids, x_kps, x_bbox, mask = batch
+        keys = np.array(keys).ravel()
         x_kps = x_kps.to(next(self.parameters()).device)
         x_bbox = x_bbox.to(next(self.parameters()).device)
         # mask = mask.to(next(self.parameters()).device)
@@ -317,16 +315,8 @@ class VAE(LightningModule):
 
         b, seq_len = x_kps.size()[:2]
         x_kps = x_kps.view(b, seq_len, 17 * 2)
-        recon_x_kps = torch.empty((b, seq_len, 0)).to(self.device)
-        for i, decoder in enumerate(self.Px_z[: 17 * 2]):
-            recon_x = decoder(x_kps[:, :, i], z[:, i, :])
-            recon_x_kps = torch.cat([recon_x_kps, recon_x], dim=2)
-
         x_bbox = x_bbox.view(b, seq_len, 2 * 2)
-        recon_x_bbox = torch.empty((b, seq_len, 0)).to(self.device)
-        for i, decoder in enumerate(self.Px_z[17 * 2 :]):
-            recon_x = decoder(x_bbox[:, :, i], z[:, i, :])
-            recon_x_bbox = torch.cat([recon_x_bbox, recon_x], dim=2)
+        recon_x_kps, recon_x_bbox = self.decode(x_kps, x_bbox, z)
 
         mse_x_kps = self.loss_x(x_kps, recon_x_kps, mask)
         mse_x_bbox = self.loss_x(x_bbox, recon_x_bbox, mask)
@@ -336,32 +326,31 @@ class VAE(LightningModule):
         x_bbox = x_bbox.view(b, seq_len, 2, 2)
         recon_x_bbox = recon_x_bbox.view(b, seq_len, 2, 2)
 
-        results = []
-        for i in range(len(keys)):
-            # label_prob = self.clustering_prob(z[i], mu[i], logvar[i], mask[i])
-            data = {
-                "key": keys[i],
-                "id": ids[i].cpu().numpy().item(),
-                # "x_kps": x_kps[0].cpu().numpy().transpose(0, 2, 3, 1),
-                # "fake_x_kps": fake_x_kps[0].cpu().numpy().transpose(0, 2, 3, 1),
-                "x_kps": x_kps[i].cpu().numpy(),
-                "recon_x_kps": recon_x_kps[i].cpu().numpy(),
-                "mse_x_kps": mse_x_kps.item(),
-                "x_bbox": x_bbox[i].cpu().numpy(),
-                "recon_x_bbox": recon_x_bbox[i].cpu().numpy(),
-                "mse_x_bbox": mse_x_bbox.item(),
-                "z": z[i].cpu().numpy(),
-                "mu": mu[i].cpu().numpy(),
-                "logvar": logvar[i].cpu().numpy(),
-                # "label_prob": label_prob[i].cpu().numpy(),
-                # "label": label_prob[i].cpu().numpy().argmax().item(),
-                "label_prob": y[i].cpu().numpy(),
-                "label": y[i].cpu().numpy().argmax().item(),
-                # "mask": mask[i].cpu().numpy(),
-            }
-            results.append(data)
+        results = batch_to_numpy(
+            key=keys,
+            id=ids.view(-1),
+            x_kps=x_kps,
+            recon_x_kps=recon_x_kps,
+            mse_x_kps=mse_x_kps.expand(b),  # mean of the batch
+            x_bbox=x_bbox,
+            recon_x_bbox=recon_x_bbox,
+            mse_x_bbox=mse_x_bbox.expand(b),
+            z=z,
+            mu=mu,
+            logvar=logvar,
+            label_prob=y,
+            label=y.argmax(dim=-1),
+        )
         return results
 
+    def decode(self, x_kps, x_bbox, z):
+        # x_kps (b, seq_len, 17 * 2), x_bbox (b, seq_len, 2 * 2)
+        x = torch.cat([x_kps, x_bbox], dim=2)
+        # decoders of bbox take z[:, :4] as same as the kps ones
+        z_idxs = list(range(17 * 2)) + list(range(2 * 2))
+        recon_x = self.Px_z(x, z[:, z_idxs])
+        return recon_x[:, :, : 17 * 2], recon_x[:, :, 17 * 2 :]
+
     def configure_optimizers(self):
         opt_pz_y = torch.optim.Adam(self.Pz_y.parameters(), lr=self.config.lr_pz_y)  # type: ignore
         opt = torch.optim.Adam(self.parameters(), lr=self.config.lr)
@@ -491,53 +480,59 @@ class Pz_y(nn.Module):
 
 
 class Px_z(nn.Module):
-    def __init__(self, config: SimpleNamespace, vis_npatchs: int = None):
+    def __init__(self, config: SimpleNamespace, n_groups: int):
         super().__init__()
+        self.n_groups = n_groups
         self.latent_ndim = config.latent_ndim
 
         self.x_start = nn.Parameter(
-            torch.randn((1, 1, config.latent_ndim), dtype=torch.float32),
+            torch.randn((n_groups, 1, 1, config.latent_ndim), dtype=torch.float32),
             requires_grad=True,
         )
 
-        self.emb = MLP(1, config.latent_ndim)
-        self.pe = RotaryEmbedding(config.latent_ndim, learned_freq=True)
-        self.mlp_z = MLP(config.latent_ndim, config.latent_ndim * config.seq_len)
+        self.emb = GroupedMLP(n_groups, 1, config.latent_ndim)
+        self.pe = GroupedRotaryEmbedding(n_groups, config.latent_ndim)
+        self.mlp_z = GroupedMLP(
+            n_groups, config.latent_ndim, config.latent_ndim * config.seq_len
+        )
         self.decoders = nn.ModuleList(
             [
-                TransformerDecoderBlock(
-                    config.latent_ndim, config.nheads, config.dropout
+                GroupedTransformerDecoderBlock(
+                    n_groups, config.latent_ndim, config.nheads, config.dropout
                 )
                 for _ in range(config.nlayers)
             ]
         )
         self.mlp = nn.Sequential(
-            MLP(config.latent_ndim, config.hidden_ndim),
+            GroupedMLP(n_groups, config.latent_ndim, config.hidden_ndim),
             nn.SiLU(),
-            MLP(config.hidden_ndim, 1),
+            GroupedMLP(n_groups, config.hidden_ndim, 1),
             nn.Tanh(),
         )
 
+        # load checkpoints of nn.ModuleList of the previous Px_z
+        self.register_load_state_dict_pre_hook(stack_grouped_state_dict)
+
     def forward(self, x, z, mask=None):
-        # x (b, seq_len)
-        # z (b, latent_ndim)
+        # x (b, seq_len, n_groups)
+        # z (b, n_groups, latent_ndim)
 
-        b, seq_len = x.size()
-        x = x.view(b, seq_len, 1)
-        x = self.emb(x)  # (b, seq_len, latent_ndim)
+        b, seq_len = x.size()[:2]
+        x = x.permute(2, 0, 1).reshape(self.n_groups, b, seq_len, 1)
+        x = self.emb(x)  # (n_groups, b, seq_len, latent_ndim)
 
         # concat start token
-        x = torch.cat([self.x_start.repeat((b, 1, 1)), x], dim=1)
-        x = x[:, :-1]  # (b, seq_len, latent_ndim)
+        x = torch.cat([self.x_start.expand(-1, b, -1, -1), x], dim=2)
+        x = x[:, :, :-1]  # (n_groups, b, seq_len, latent_ndim)
 
-        x = self.pe.rotate_queries_or_keys(x, seq_dim=1)
+        x = self.pe.rotate_queries_or_keys(x)
 
-        z = self.mlp_z(z)
-        z = z.view(b, seq_len, self.latent_ndim)
+        z = self.mlp_z(z.permute(1, 0, 2))
+        z = z.view(self.n_groups, b, seq_len, self.latent_ndim)
         for layer in self.decoders:
             x = layer(x, z, mask)
-        # x (b, seq_len, latent_ndim)
+        # x (n_groups, b, seq_len, latent_ndim)
 
-        recon_x = self.mlp(x).view(b, seq_len, 1)
+        recon_x = self.mlp(x).view(self.n_groups, b, seq_len)
 
-        return recon_x
+        return recon_x.permute(1, 2, 0)  # (b, seq_len, n_groups)
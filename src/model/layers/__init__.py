@@ -1,2 +1,9 @@
 from .feedforward import MLP, SwiGLU
+from .grouped import (
+    GroupedLinear,
+    GroupedMLP,
+    GroupedRotaryEmbedding,
+    GroupedTransformerDecoderBlock,
+    stack_grouped_state_dict,
+)
 from .transformer import TransformerDecoderBlock, TransformerEncoderBlock
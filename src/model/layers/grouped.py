@@ -0,0 +1,212 @@
+import math
+import re
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from .transformer import create_src_mask, create_tgt_mask
+
+# Layers with independent weights for each group, computed in a single batched
+# kernel. Inputs and outputs are (n_groups, b, ..., ndim). Parameters are the
+# ones of the corresponding nn layers stacked at dim 0, so that a ModuleList of
+# the per-group modules can be converted by stack_grouped_state_dict.
+
+
+class GroupedLinear(nn.Module):
+    def __init__(self, n_groups: int, in_ndim: int, out_ndim: int, bias=True):
+        super().__init__()
+        self.weight = nn.Parameter(torch.empty(n_groups, out_ndim, in_ndim))
+        if bias:
+            self.bias = nn.Parameter(torch.empty(n_groups, out_ndim))
+        else:
+            self.register_parameter("bias", None)
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # same as nn.Linear for each group
+        for i in range(self.weight.size(0)):
+            nn.init.kaiming_uniform_(self.weight[i], a=math.sqrt(5))
+        if self.bias is not None:
+            bound = 1 / math.sqrt(self.weight.size(2))
+            nn.init.uniform_(self.bias, -bound, bound)
+
+    def forward(self, x):
+        return grouped_linear(x, self.weight, self.bias)
+
+
+def grouped_linear(x, weight, bias=None):
+    n_groups, out_ndim, in_ndim = weight.size()
+    shape = x.size()
+    x = x.reshape(n_groups, -1, in_ndim)
+    if bias is not None:
+        x = torch.baddbmm(bias.unsqueeze(1), x, weight.transpose(1, 2))
+    else:
+        x = torch.bmm(x, weight.transpose(1, 2))
+    return x.view(*shape[:-1], out_ndim)
+
+
+def _expand_group_param(param, x):
+    # (n_groups, ndim) -> (n_groups, 1, ..., 1, ndim)
+    return param.view(param.size(0), *([1] * (x.ndim - 2)), param.size(-1))
+
+
+class GroupedLayerNorm(nn.Module):
+    def __init__(self, n_groups: int, ndim: int, eps: float = 1e-5):
+        super().__init__()
+        self.eps = eps
+        self.weight = nn.Parameter(torch.ones(n_groups, ndim))
+        self.bias = nn.Parameter(torch.zeros(n_groups, ndim))
+
+    def forward(self, x):
+        x = F.layer_norm(x, x.shape[-1:], eps=self.eps)
+        return x * _expand_group_param(self.weight, x) + _expand_group_param(
+            self.bias, x
+        )
+
+
+class GroupedMLP(nn.Module):
+    def __init__(
+        self, n_groups: int, in_ndim: int, out_ndim: int = None, dropout: float = 0.1
+    ):
+        super().__init__()
+        if out_ndim is None:
+            out_ndim = in_ndim
+        hdim = int(in_ndim * 4 * (2 / 3))
+        self.mlp = nn.Sequential(
+            GroupedLinear(n_groups, in_ndim, hdim),
+            nn.SiLU(),
+            nn.Dropout(dropout),
+            GroupedLinear(n_groups, hdim, out_ndim),
+        )
+
+    def forward(self, x):
+        return self.mlp(x)
+
+
+class GroupedSwiGLU(nn.Module):
+    def __init__(self, n_groups: int, in_ndim: int, out_ndim: int = None):
+        super().__init__()
+        if out_ndim is None:
+            out_ndim = in_ndim
+        hdim = int(in_ndim * 4 * (2 / 3))
+        self.w1 = GroupedLinear(n_groups, in_ndim, hdim)
+        self.w2 = GroupedLinear(n_groups, hdim, out_ndim)
+        self.w3 = GroupedLinear(n_groups, in_ndim, hdim)
+
+    def forward(self, x):
+        return self.w2(F.silu(self.w1(x)) * self.w3(x))
+
+
+class GroupedRotaryEmbedding(nn.Module):
+    # rotary_embedding_torch.RotaryEmbedding(ndim, learned_freq=True) of each group
+    def __init__(self, n_groups: int, ndim: int, theta: float = 10000):
+        super().__init__()
+        freqs = torch.arange(0, ndim, 2)[: (ndim // 2)].float() / ndim
+        freqs = 1.0 / (theta**freqs)
+        self.freqs = nn.Parameter(freqs.repeat(n_groups, 1))
+
+    def rotate_queries_or_keys(self, x):
+        # x (n_groups, b, seq_len, ndim)
+        seq_len = x.size(2)
+        t = torch.arange(seq_len, device=x.device, dtype=self.freqs.dtype)
+        freqs = torch.einsum("t,gf->gtf", t, self.freqs)
+        freqs = freqs.repeat_interleave(2, dim=-1).unsqueeze(1)
+
+        x_rot = x.view(*x.shape[:-1], -1, 2)
+        x_rot = torch.stack([-x_rot[..., 1], x_rot[..., 0]], dim=-1).view(x.shape)
+        return (x * freqs.cos() + x_rot * freqs.sin()).to(x.dtype)
+
+
+class GroupedMultiheadAttention(nn.Module):
+    # nn.MultiheadAttention(ndim, nheads, batch_first=True) of each group
+    def __init__(self, n_groups: int, ndim: int, nheads: int, dropout: float = 0.0):
+        super().__init__()
+        self.nheads = nheads
+        self.dropout = dropout
+        self.in_proj_weight = nn.Parameter(torch.empty(n_groups, 3 * ndim, ndim))
+        self.in_proj_bias = nn.Parameter(torch.zeros(n_groups, 3 * ndim))
+        self.out_proj = GroupedLinear(n_groups, ndim, ndim)
+        for i in range(n_groups):
+            nn.init.xavier_uniform_(self.in_proj_weight[i])
+        nn.init.zeros_(self.out_proj.bias)
+
+    def forward(self, q, k, v, attn_mask=None):
+        # q (n_groups, b, seq_len, ndim), k and v (n_groups, b, src_len, ndim)
+        # attn_mask (b * nheads, seq_len, src_len) or (seq_len, src_len)
+        # True of attn_mask is masked as same as nn.MultiheadAttention
+        n_groups, b, seq_len, ndim = q.size()
+        w_q, w_k, w_v = self.in_proj_weight.chunk(3, dim=1)
+        b_q, b_k, b_v = self.in_proj_bias.chunk(3, dim=1)
+        q = self._split_heads(grouped_linear(q, w_q, b_q))
+        k = self._split_heads(grouped_linear(k, w_k, b_k))
+        v = self._split_heads(grouped_linear(v, w_v, b_v))
+
+        if attn_mask is not None:
+            if attn_mask.ndim == 3:
+                attn_mask = attn_mask.view(b, self.nheads, *attn_mask.shape[1:])
+            attn_mask = ~attn_mask.to(torch.bool)
+        dropout = self.dropout if self.training else 0.0
+        x = F.scaled_dot_product_attention(
+            q, k, v, attn_mask=attn_mask, dropout_p=dropout
+        )
+
+        x = x.transpose(2, 3).reshape(n_groups, b, seq_len, ndim)
+        return self.out_proj(x)
+
+    def _split_heads(self, x):
+        # (n_groups, b, seq_len, ndim) -> (n_groups, b, nheads, seq_len, hdim)
+        n_groups, b, seq_len, ndim = x.size()
+        x = x.view(n_groups, b, seq_len, self.nheads, ndim // self.nheads)
+        return x.transpose(2, 3)
+
+
+class GroupedTransformerDecoderBlock(nn.Module):
+    # TransformerDecoderBlock of each group
+    def __init__(self, n_groups: int, ndim: int, nheads: int, dropout: float):
+        super().__init__()
+        self.nheads = nheads
+        self.norm1 = GroupedLayerNorm(n_groups, ndim)
+        self.attn1 = GroupedMultiheadAttention(n_groups, ndim, nheads, dropout)
+
+        self.norm2 = GroupedLayerNorm(n_groups, ndim)
+        self.attn2 = GroupedMultiheadAttention(n_groups, ndim, nheads, dropout)
+
+        self.norm3 = GroupedLayerNorm(n_groups, ndim)
+        self.ff = GroupedSwiGLU(n_groups, ndim)
+        self.dropout3 = nn.Dropout(dropout)
+
+    def forward(self, x, z, mask=None):
+        # x (n_groups, b, seq_len, ndim)
+        b, seq_len = x.size()[1:3]
+        tgt_mask = create_tgt_mask(mask, b, seq_len, self.nheads, x.device)
+        x = self.norm1(x)
+        x = x + self.attn1(x, x, x, tgt_mask)
+
+        if mask is not None:
+            src_mask = create_src_mask(mask, b, seq_len, self.nheads)
+        else:
+            src_mask = None
+        x = self.norm2(x)
+        x = x + self.attn2(x, z, z, src_mask)
+
+        x = self.norm3(x)
+        x = x + self.dropout3(self.ff(x))
+
+        return x
+
+
+def stack_grouped_state_dict(module, state_dict, prefix, *args):
+    # load_state_dict pre-hook to convert a state dict of nn.ModuleList of
+    # per-group modules, "{prefix}{i}.{name}" are stacked into "{prefix}{name}"
+    pattern = re.compile(rf"^{re.escape(prefix)}(\d+)\.(.+)$")
+    params = {}
+    for key in list(state_dict.keys()):
+        match = pattern.match(key)
+        if match is None:
+            continue
+        i, name = int(match.group(1)), match.group(2)
+        params.setdefault(name, {})[i] = state_dict.pop(key)
+
+    for name, vals in params.items():
+        state_dict[prefix + name] = torch.stack([vals[i] for i in sorted(vals)])
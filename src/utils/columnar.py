@@ -0,0 +1,92 @@
+import json
+import os
+
+import numpy as np
+
+
+class ColumnarWriter:
+    def __init__(self, dir_path: str, attrs: dict = None):
+        os.makedirs(dir_path, exist_ok=True)
+        self.dir_path = dir_path
+        self.attrs = attrs if attrs is not None else {}
+        self.columns = {}
+        self.files = {}
+        self.length = 0
+
+    def append(self, **columns):
+        # all columns are appended with the same number of rows
+        lengths = set([len(vals) for vals in columns.values()])
+        assert len(lengths) == 1, "lengths of columns are not same"
+        if len(self.columns) > 0:
+            assert set(columns.keys()) == set(self.columns.keys())
+
+        for name, vals in columns.items():
+            vals = np.asarray(vals)
+            if name not in self.columns:
+                self.columns[name] = {
+                    "dtype": vals.dtype.str,
+                    "shape": list(vals.shape[1:]),
+                }
+                path = os.path.join(self.dir_path, f"{name}.bin")
+                self.files[name] = open(path, "wb")
+            col = self.columns[name]
+            vals = np.ascontiguousarray(vals, dtype=np.dtype(col["dtype"]))
+            assert list(vals.shape[1:]) == col["shape"], f"shape of {name} mismatched"
+            self.files[name].write(vals.tobytes())
+        self.length += lengths.pop()
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+
+        # meta is written at last, a store without meta is an incomplete one
+        meta = {"length": self.length, "columns": self.columns, "attrs": self.attrs}
+        tmp_path = os.path.join(self.dir_path, "meta.json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, os.path.join(self.dir_path, "meta.json"))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def is_columnar(dir_path: str) -> bool:
+    return os.path.exists(os.path.join(dir_path, "meta.json"))
+
+
+def _load_meta(dir_path: str) -> dict:
+    with open(os.path.join(dir_path, "meta.json"), "r") as f:
+        return json.load(f)
+
+
+def load_attrs(dir_path: str) -> dict:
+    return _load_meta(dir_path).get("attrs", {})
+
+
+def load_length(dir_path: str) -> int:
+    # a store without rows has no columns
+    return _load_meta(dir_path)["length"]
+
+
+def load_columns(dir_path: str, names: list = None) -> dict:
+    meta = _load_meta(dir_path)
+
+    length = meta["length"]
+    columns = {}
+    for name, col in meta["columns"].items():
+        if names is not None and name not in names:
+            continue
+        dtype = np.dtype(col["dtype"])
+        shape = (length, *col["shape"])
+        if length == 0:
+            # empty file cannot be memory-mapped
+            columns[name] = np.empty(shape, dtype)
+        else:
+            path = os.path.join(dir_path, f"{name}.bin")
+            columns[name] = np.memmap(path, dtype, mode="r", shape=shape)
+
+    return columns
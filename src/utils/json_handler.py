@@ -1,5 +1,6 @@
 import json
 import os
+import re
 from json import JSONEncoder
 
 import numpy as np
@@ -20,6 +21,46 @@ def load(json_path):
     return data
 
 
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+def iter_list(json_path, chunk_size=1 << 20):
+    # stream the elements of a top-level json list without loading the whole file
+    decoder = json.JSONDecoder()
+    with open(json_path, "r") as f:
+        buf = f.read(chunk_size)
+        pos = _WHITESPACE.match(buf, 0).end()
+        if buf[pos : pos + 1] != "[":
+            raise ValueError(f"{json_path} is not a list")
+        pos += 1
+        is_eof = False
+        while True:
+            pos = _WHITESPACE.match(buf, pos).end()
+            if pos < len(buf) and buf[pos] == "]":
+                return
+            if pos < len(buf) and buf[pos] == ",":
+                pos = _WHITESPACE.match(buf, pos + 1).end()
+
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+                # the element might be truncated at the end of the buffer
+                is_complete = end < len(buf) or is_eof
+            except json.JSONDecodeError:
+                if is_eof:
+                    raise
+                is_complete = False
+
+            if not is_complete:
+                chunk = f.read(chunk_size)
+                is_eof = chunk == ""
+                buf = buf[pos:] + chunk
+                pos = 0
+                continue
+
+            yield obj
+            pos = end
+
+
 def dump(json_path, data):
     if os.path.dirname(data) != "":
         os.makedirs(os.path.dirname(json_path), exist_ok=True)
@@ -0,0 +1,48 @@
+import numpy as np
+
+from src.model.human_tracking.ext.BoostTrack.boost_track import BoostTrack
+
+IMG = np.zeros((480, 640, 3), dtype=np.uint8)
+IMG_TENSOR = IMG[np.newaxis].transpose(0, 3, 1, 2)
+EMPTY = np.empty((0, 5))
+DETS = np.array([[10, 10, 100, 200, 0.9], [300, 200, 400, 400, 0.8]])
+
+
+def _update(tracker: BoostTrack, dets: np.ndarray) -> np.ndarray:
+    return tracker.update(dets, IMG_TENSOR, IMG, None)
+
+
+def test_empty_frames_before_first_detection():
+    tracker = BoostTrack(det_thresh=0.5)
+    for _ in range(3):
+        assert _update(tracker, EMPTY).shape == (0, 7)
+
+    # all detections below det_thresh
+    assert _update(tracker, np.array([[10, 10, 100, 200, 0.1]])).shape == (0, 7)
+
+    # a new tracklet is output after min_hits updates following its creation
+    for _ in range(tracker.min_hits + 1):
+        tracks = _update(tracker, DETS)
+    assert len(tracks) == 2
+    assert sorted(tracks[:, 6].astype(int)) == [0, 1]
+
+
+def test_empty_frames_after_reset():
+    tracker = BoostTrack(det_thresh=0.5)
+    for _ in range(5):
+        _update(tracker, DETS)
+
+    tracker.reset()
+    assert tracker.frame_count == 0
+    for _ in range(3):
+        assert _update(tracker, EMPTY).shape == (0, 7)
+
+
+def test_reset_restarts_warm_up():
+    tracker = BoostTrack(det_thresh=0.5)
+    for _ in range(5):
+        _update(tracker, DETS)
+
+    tracker.reset()
+    # new tracklets are output from the first frame during warm-up
+    assert len(_update(tracker, DETS)) == 2
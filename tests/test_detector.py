@@ -0,0 +1,69 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from src.model.human_tracking.detector import Detector
+
+CFG = SimpleNamespace(pose=SimpleNamespace(th_diff=10.0, th_count=3))
+
+
+def _get_unique_pairwise(kps, indices, th_diff, th_count):
+    # the pairwise loop replaced by Detector._get_unique
+    remain_indices = np.empty((0,), dtype=np.int32)
+
+    for idx in indices:
+        for ridx in remain_indices:
+            diff = np.linalg.norm(kps[idx, :, :2] - kps[ridx, :, :2], axis=1)
+
+            if len(np.where(diff < th_diff)[0]) >= th_count:
+                if np.mean(kps[idx, :, 2]) > np.mean(kps[ridx, :, 2]):
+                    remain_indices[remain_indices == ridx] = idx
+
+                break
+        else:
+            remain_indices = np.append(remain_indices, idx)
+
+    return remain_indices
+
+
+@pytest.fixture
+def detector():
+    # skip loading models, only the config is used by _get_unique
+    detector = Detector.__new__(Detector)
+    detector._cfg = CFG
+    detector._yolo = detector._pose_model = None
+    return detector
+
+
+def _make_kps(centres, confs, n_points=17):
+    offsets = np.linspace(-20, 20, n_points)[:, np.newaxis]
+    pts = np.asarray(centres, np.float32)[:, np.newaxis] + offsets
+    scores = np.repeat(np.asarray(confs, np.float32)[:, np.newaxis], n_points, 1)
+    return np.concatenate([pts, scores[:, :, np.newaxis]], axis=2)
+
+
+def test_get_unique_chain(detector):
+    # B overlaps both A and C, A and C do not overlap
+    kps = _make_kps([[0, 0], [12, 0], [6, 0]], [0.5, 0.7, 0.9])
+    indices = np.array([0, 1, 2])
+
+    # B replaces A in place and C is kept
+    unique = detector._get_unique(kps, indices)
+    np.testing.assert_array_equal(unique, [2, 1])
+    np.testing.assert_array_equal(unique, _get_unique_pairwise(kps, indices, 10, 3))
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_get_unique_same_as_pairwise(detector, seed):
+    rng = np.random.default_rng(seed)
+    n = rng.integers(0, 30)
+    # poses around close centres so that many pairs overlap
+    pts = rng.uniform(0, 50, (n, 1, 2)) + rng.normal(0, 8, (n, 17, 2))
+    scores = rng.choice([0.3, 0.5, 0.7, 0.9], (n, 17, 1))
+    kps = np.concatenate([pts, scores], axis=2).astype(np.float32)
+    indices = np.sort(rng.choice(n, rng.integers(0, n + 1), replace=False))
+
+    unique = detector._get_unique(kps, indices)
+    expected = _get_unique_pairwise(kps, indices, CFG.pose.th_diff, CFG.pose.th_count)
+    np.testing.assert_array_equal(unique, expected)